@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""Compares the eager mode with the compiled mode (--compile).
+
+The audio file is processed in the computationally unaware simulation three times, every time in
+a new process: in the eager mode, in the compiled mode with an empty cache of compiled kernels
+(the first start), and in the compiled mode again with the cache from the previous run (a restart).
+For each run, it reports the cold-start time, i.e. loading the model and the warmup that compiles
+it, the steady-state decoder throughput in tokens per second, the latency of process_iter, and the
+WER against the reference transcript (or against the eager mode output, if the reference is not given).
+
+Run it from the SimulStreaming directory:
+
+    python3 -m benchmarks.compiled audio.wav --reference audio.txt --encoder_bucket 5.0 --model_path small.pt
+"""
+
+import argparse
+import json
+import logging
+import subprocess
+import sys
+import tempfile
+import time
+
+from simulstreaming_whisper import simulwhisper_args, simul_asr_factory
+from whisper_streaming.whisper_online_main import processor_args, asr_factory, set_logging, load_audio
+from benchmarks.encoder_modes import simulate, report, word_error_rate
+
+logger = logging.getLogger(__name__)
+
+SAMPLING_RATE = 16000
+RESULT_PREFIX = "RESULT "
+
+
+class DecoderTimer:
+    '''Counts the decoder forward passes of PaddedAlignAttWhisper.logits and measures their wall time.'''
+
+    def __init__(self, model):
+        self.times = []
+        self.logits = model.logits
+        model.logits = self
+
+    def __call__(self, tokens, audio_features):
+        start = time.perf_counter()
+        logits = self.logits(tokens, audio_features)
+        self.times.append(time.perf_counter() - start)
+        return logits
+
+
+def run(args):
+    '''One run in this process, returns the results as a dict'''
+    start = time.perf_counter()
+    asr, online = asr_factory(args, simul_asr_factory)
+    audio = load_audio(args.audio_path)
+    asr.warmup(audio[:SAMPLING_RATE])
+    cold_start = time.perf_counter() - start
+
+    timer = DecoderTimer(online.model)
+    min_chunk = args.vac_chunk_size if args.vac else args.min_chunk_size
+    text, iter_times = simulate(online, audio, min_chunk)
+    return {"cold_start": cold_start, "decoder_steps": len(timer.times), "decoder_time": sum(timer.times),
+            "iter_times": iter_times, "text": text}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    processor_args(parser)
+    simulwhisper_args(parser)
+    parser.add_argument('audio_path', type=str, help="Filename of 16kHz mono channel wav.")
+    parser.add_argument('--reference', type=str, default=None,
+                        help="Text file with the reference transcript. If not set, the output of the eager mode is the reference.")
+    parser.add_argument('--run', action="store_true", default=False, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    set_logging(args, logger)
+
+    if args.run:
+        print(RESULT_PREFIX + json.dumps(run(args)))
+        return
+
+    outputs = {}
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for name, options in [("eager", []),
+                              ("compiled, empty cache", ["--compile", "--compile_cache_dir", cache_dir]),
+                              ("compiled, cached", ["--compile", "--compile_cache_dir", cache_dir])]:
+            logger.info(f"running {name}")
+            command = [sys.executable, "-m", "benchmarks.compiled"] + sys.argv[1:] + options + ["--run"]
+            result = subprocess.run(command, stdout=subprocess.PIPE, text=True, check=True)
+            line = [l for l in result.stdout.splitlines() if l.startswith(RESULT_PREFIX)][-1]
+            outputs[name] = json.loads(line[len(RESULT_PREFIX):])
+
+    if args.reference is not None:
+        with open(args.reference) as f:
+            reference = f.read()
+    else:
+        reference = outputs["eager"]["text"]
+
+    for name, out in outputs.items():
+        print(f"=== {name}")
+        print(f"WER: {word_error_rate(reference, out['text']):.4f}")
+        print(f"cold start (load and warmup): {out['cold_start']:.2f} s")
+        print(f"decoder: {out['decoder_steps']} forward passes, {out['decoder_steps'] / max(out['decoder_time'], 1e-9):.1f} tokens/s")
+        print(report("process_iter:", out["iter_times"]))
+        print(f"text: {out['text']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""Compares the padded 30s encoder input with the content-length encoder input (--encoder_bucket).
+
+The audio file is processed twice by the same model in the computationally unaware simulation,
+once in each mode. For each mode, it reports the WER against the reference transcript (or against
+the padded mode output, if the reference is not given), and the latency of the encoder and of the
+whole process_iter call.
+
+Run it from the SimulStreaming directory:
+
+    python3 -m benchmarks.encoder_modes audio.wav --reference audio.txt --encoder_bucket 2.0 --model_path base.pt
+"""
+
+import argparse
+import logging
+import re
+import time
+
+import numpy as np
+
+from simulstreaming_whisper import simulwhisper_args, simul_asr_factory
+from whisper_streaming.whisper_online_main import processor_args, asr_factory, set_logging, load_audio
+
+logger = logging.getLogger(__name__)
+
+SAMPLING_RATE = 16000
+
+
+def normalize(text):
+    '''lowercase, without punctuation'''
+    return re.sub(r"[^\w\s']", " ", text.lower()).split()
+
+
+def word_error_rate(reference, hypothesis):
+    '''WER of the normalized word sequences, by Levenshtein distance.'''
+    ref = normalize(reference)
+    hyp = normalize(hypothesis)
+    if not ref:
+        return float(len(hyp) > 0)
+    dist = list(range(len(hyp) + 1))
+    for i, r in enumerate(ref, 1):
+        prev, dist[0] = dist[0], i
+        for j, h in enumerate(hyp, 1):
+            prev, dist[j] = dist[j], min(dist[j] + 1, dist[j - 1] + 1, prev + (r != h))
+    return dist[-1] / len(ref)
+
+
+class EncoderTimer:
+    '''Measures the wall time of every encoder forward pass, with forward hooks.'''
+
+    def __init__(self, encoder):
+        self.times = []
+        self.start = None
+        encoder.register_forward_pre_hook(self.pre_hook)
+        encoder.register_forward_hook(self.hook)
+
+    def pre_hook(self, module, net_input):
+        self.start = time.perf_counter()
+
+    def hook(self, module, net_input, net_output):
+        self.times.append(time.perf_counter() - self.start)
+
+
+def simulate(online, audio, min_chunk):
+    '''Computationally unaware simulation. Returns the output text and the process_iter times.'''
+    online.init()
+    texts = []
+    iter_times = []
+    chunk = int(min_chunk * SAMPLING_RATE)
+    for beg in range(0, len(audio), chunk):
+        online.insert_audio_chunk(audio[beg:beg + chunk])
+        start = time.perf_counter()
+        o = online.process_iter()
+        iter_times.append(time.perf_counter() - start)
+        texts.append(o[2])
+    texts.append(online.finish()[2])
+    return "".join(texts), iter_times
+
+
+def report(name, times):
+    times = np.array(times) * 1000
+    return f"{name} mean {times.mean():.1f} ms, p50 {np.percentile(times, 50):.1f} ms, p90 {np.percentile(times, 90):.1f} ms"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    processor_args(parser)
+    simulwhisper_args(parser)
+    parser.add_argument('audio_path', type=str, help="Filename of 16kHz mono channel wav.")
+    parser.add_argument('--reference', type=str, default=None,
+                        help="Text file with the reference transcript. If not set, the output of the padded mode is the reference.")
+    args = parser.parse_args()
+    if args.encoder_bucket is None:
+        args.encoder_bucket = 2.0
+    set_logging(args, logger)
+
+    asr, online = asr_factory(args, simul_asr_factory)
+    model = asr.model
+    timer = EncoderTimer(model.model.encoder)
+
+    audio = load_audio(args.audio_path)
+    min_chunk = args.vac_chunk_size if args.vac else args.min_chunk_size
+    asr.warmup(audio[:SAMPLING_RATE])
+
+    outputs = {}
+    for name, bucket in [("padded", None), (f"content (bucket {args.encoder_bucket}s)", args.encoder_bucket)]:
+        model.cfg.encoder_bucket = bucket
+        timer.times = []
+        text, iter_times = simulate(online, audio, min_chunk)
+        outputs[name] = (text, iter_times, timer.times)
+
+    if args.reference is not None:
+        with open(args.reference) as f:
+            reference = f.read()
+    else:
+        reference = outputs["padded"][0]
+
+    for name, (text, iter_times, enc_times) in outputs.items():
+        print(f"=== {name}")
+        print(f"WER: {word_error_rate(reference, text):.4f}")
+        print(report("encoder:", enc_times))
+        print(report("process_iter:", iter_times))
+        print(f"text: {text}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""Compares the conversion of the received PCM16 packets to float32 audio in the server.
+
+The old path creates a soundfile.SoundFile over io.BytesIO and calls librosa.load for every packet,
+and concatenates the packets of a chunk. The new path is PCM16Buffer. Both paths get the same packets
+of random audio, the output is checked to be equal, and the time per packet is reported.
+
+Run it from the SimulStreaming directory:
+
+    python3 -m benchmarks.pcm_decoding --packet-size 4096 --chunk 1.0
+"""
+
+import argparse
+import io
+import time
+
+import librosa
+import numpy as np
+import soundfile
+
+from whisper_streaming.pcm_buffer import PCM16Buffer
+
+SAMPLING_RATE = 16000
+
+
+def decode_soundfile(packets, chunk_samples):
+    '''the path of ServerProcessor.receive_audio_chunk before PCM16Buffer'''
+    chunks = []
+    out = []
+    for raw_bytes in packets:
+        sf = soundfile.SoundFile(io.BytesIO(raw_bytes), channels=1, endian="LITTLE", samplerate=SAMPLING_RATE, subtype="PCM_16", format="RAW")
+        audio, _ = librosa.load(sf, sr=SAMPLING_RATE, dtype=np.float32)
+        out.append(audio)
+        if sum(len(x) for x in out) >= chunk_samples:
+            chunks.append(np.concatenate(out))
+            out = []
+    if out:
+        chunks.append(np.concatenate(out))
+    return chunks
+
+
+def decode_pcm_buffer(packets, chunk_samples):
+    chunks = []
+    buffer = PCM16Buffer(capacity=2*chunk_samples)
+    for raw_bytes in packets:
+        buffer.add(raw_bytes)
+        if len(buffer) >= chunk_samples:
+            chunks.append(buffer.take())
+    if len(buffer):
+        chunks.append(buffer.take())
+    return chunks
+
+
+def measure(decode, packets, chunk_samples, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        chunks = decode(packets, chunk_samples)
+        times.append(time.perf_counter() - start)
+    return chunks, min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--packet-size', type=int, default=4096, dest="packet_size", help="Bytes per received packet. Use an even number, "
+                        "the old path can't decode samples split between packets.")
+    parser.add_argument('--chunk', type=float, default=1.0, help="Seconds of audio per processed chunk, as --min-chunk-size.")
+    parser.add_argument('--seconds', type=float, default=60.0, help="Seconds of audio in total.")
+    parser.add_argument('--repeat', type=int, default=5, help="The best time of this many runs is reported.")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    data = rng.integers(-32768, 32768, size=int(args.seconds*SAMPLING_RATE), dtype=np.int16).astype('<i2').tobytes()
+    packets = [data[beg:beg + args.packet_size] for beg in range(0, len(data), args.packet_size)]
+    chunk_samples = int(args.chunk*SAMPLING_RATE)
+
+    old_chunks, old_time = measure(decode_soundfile, packets, chunk_samples, args.repeat)
+    new_chunks, new_time = measure(decode_pcm_buffer, packets, chunk_samples, args.repeat)
+    assert np.array_equal(np.concatenate(old_chunks), np.concatenate(new_chunks)), "the outputs differ"
+
+    for name, t in [("soundfile + librosa", old_time), ("PCM16Buffer", new_time)]:
+        print(f"{name}: {t*1000:.1f} ms for {len(packets)} packets, {t/len(packets)*1e6:.1f} us per packet")
+    print(f"speedup: {old_time/new_time:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
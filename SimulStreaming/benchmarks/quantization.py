@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""Compares the fp32 model with the dynamically quantized int8 model (--int8) on CPU.
+
+The audio file is processed by both models in the computationally unaware simulation. For each
+model, it reports the WER against the reference transcript (or against the fp32 output, if the
+reference is not given), the latency of the encoder and of the whole process_iter call, the size
+of the weights and the growth of the process RSS by loading the model.
+
+Run it from the SimulStreaming directory:
+
+    python3 -m benchmarks.quantization audio.wav --reference audio.txt --model_path small.pt
+"""
+
+import argparse
+import copy
+import io
+import logging
+
+import torch
+
+from simulstreaming_whisper import simulwhisper_args, simul_asr_factory
+from whisper_streaming.whisper_online_main import processor_args, asr_factory, set_logging, load_audio
+from benchmarks.encoder_modes import EncoderTimer, simulate, report, word_error_rate
+
+logger = logging.getLogger(__name__)
+
+SAMPLING_RATE = 16000
+
+
+def rss_mb():
+    '''the resident set size of this process in MB, from /proc. None where it's not available.'''
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def weights_mb(model):
+    '''the size of the serialized state dict in MB, the int8 weights are packed'''
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell() / 2**20
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    processor_args(parser)
+    simulwhisper_args(parser)
+    parser.add_argument('audio_path', type=str, help="Filename of 16kHz mono channel wav.")
+    parser.add_argument('--reference', type=str, default=None,
+                        help="Text file with the reference transcript. If not set, the output of the fp32 model is the reference.")
+    parser.add_argument('--threads', type=int, default=None, help="torch.set_num_threads, for both models.")
+    args = parser.parse_args()
+    set_logging(args, logger)
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    audio = load_audio(args.audio_path)
+    min_chunk = args.vac_chunk_size if args.vac else args.min_chunk_size
+
+    outputs = {}
+    for name, int8 in [("fp32", False), ("int8", True)]:
+        mode_args = copy.copy(args)
+        mode_args.int8 = int8
+        rss_before = rss_mb()
+        asr, online = asr_factory(mode_args, simul_asr_factory)
+        rss_after = rss_mb()
+        model = asr.model
+        if model.model.device.type != "cpu":
+            logger.warning(f"The {name} model runs on {model.model.device}, the comparison is meant for CPU.")
+        timer = EncoderTimer(model.model.encoder)
+        asr.warmup(audio[:SAMPLING_RATE])
+        timer.times = []
+        text, iter_times = simulate(online, audio, min_chunk)
+        rss = None if rss_before is None else rss_after - rss_before
+        outputs[name] = (text, iter_times, timer.times, weights_mb(model.model), rss)
+        del asr, online, model
+
+    if args.reference is not None:
+        with open(args.reference) as f:
+            reference = f.read()
+    else:
+        reference = outputs["fp32"][0]
+
+    for name, (text, iter_times, enc_times, weights, rss) in outputs.items():
+        print(f"=== {name}")
+        print(f"WER: {word_error_rate(reference, text):.4f}")
+        print(report("encoder:", enc_times))
+        print(report("process_iter:", iter_times))
+        print(f"weights: {weights:.1f} MB" + ("" if rss is None else f", RSS growth by loading: {rss:.1f} MB"))
+        print(f"text: {text}")
+
+    fp32, int8 = outputs["fp32"], outputs["int8"]
+    print(f"=== int8 speedup: encoder {sum(fp32[2])/max(sum(int8[2]), 1e-9):.2f}x, "
+          f"process_iter {sum(fp32[1])/max(sum(int8[1]), 1e-9):.2f}x")
+
+
+if __name__ == "__main__":
+    main()
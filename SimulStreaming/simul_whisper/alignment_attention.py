@@ -0,0 +1,77 @@
+import torch
+import torch.nn.functional as F
+
+from .whisper.timing import median_filter
+
+# Incremental tracking of the cross-attention of the alignment heads, for the AlignAtt policy.
+
+class AlignmentAttention:
+    """Tracks the cross-attention of the alignment heads over the decoded tokens.
+
+    The AlignAtt policy needs the most attended audio frame of the last token. The attention of
+    each head is normalized by the mean and std over all the tokens so far, filtered by a median
+    filter along the audio frames, and averaged over the heads. Instead of keeping all the attention
+    rows and recomputing this for the whole matrix at every step, only the running mean and variance
+    over the tokens are kept (Chan et al. parallel algorithm), and only the last row is normalized
+    and filtered.
+
+    align_source: {layer_rank: [(align_head_rank, head_id), ...]}, as in PaddedAlignAttWhisper
+    """
+
+    def __init__(self, align_source, num_align_heads, filter_width=7):
+        self.align_source = align_source
+        self.num_align_heads = num_align_heads
+        self.filter_width = filter_width
+        self.reset()
+
+    def reset(self):
+        self.pending = {}  # align_head_rank -> attention of the new tokens, B*new_tokens*audio_len
+        self.count = 0
+        self.mean = None  # B*num_align_heads*1*audio_len, over all the tokens so far
+        self.m2 = None  # sum of squared differences from the mean
+        self.last = None  # attention of the last token, B*num_align_heads*1*audio_len
+
+    def add(self, layer_rank, qk):
+        """qk: the cross-attention logits of one decoder layer, B*num_head*new_tokens*audio_len"""
+        for align_head_rank, head_id in self.align_source.get(layer_rank, []):
+            self.pending[align_head_rank] = F.softmax(qk[:, head_id, :, :], dim=-1)
+
+    def split_pending(self):
+        """Removes the attention of the new tokens that is not processed yet, and returns it split per token:
+        a list of {align_head_rank: B*1*audio_len}. Putting them back one by one by set_pending, each followed by
+        most_attended_frames, gives the same as a decoder forward per token. It's for the speculative decoding."""
+        pending, self.pending = self.pending, {}
+        n_new = min((attn.shape[1] for attn in pending.values()), default=0)
+        return [{rank: attn[:, i:i + 1] for rank, attn in pending.items()} for i in range(n_new)]
+
+    def set_pending(self, pending):
+        self.pending = pending
+
+    def _update(self):
+        if not self.pending:
+            return
+        assert len(self.pending) == self.num_align_heads, "attention of some alignment heads is missing"
+        new = torch.stack([self.pending[i] for i in range(self.num_align_heads)], dim=1).double()
+        self.pending = {}
+
+        n_new = new.shape[2]
+        new_mean = new.mean(dim=2, keepdim=True)
+        new_m2 = ((new - new_mean) ** 2).sum(dim=2, keepdim=True)
+        if self.count == 0:
+            self.mean, self.m2 = new_mean, new_m2
+        else:
+            n = self.count + n_new
+            delta = new_mean - self.mean
+            self.mean = self.mean + delta * n_new / n
+            self.m2 = self.m2 + new_m2 + delta ** 2 * self.count * n_new / n
+        self.count += n_new
+        self.last = new[:, :, -1:, :]
+
+    def most_attended_frames(self, content_mel_len):
+        """For each beam, the audio frame that is the most attended by the last token, among the first content_mel_len frames"""
+        self._update()
+        std = (self.m2 / self.count).sqrt()
+        attn = ((self.last - self.mean) / std).float()
+        attn = median_filter(attn, self.filter_width)  # from whisper.timing
+        attn = attn.mean(dim=1)[:, -1, :content_mel_len]
+        return torch.argmax(attn, dim=-1)
@@ -0,0 +1,221 @@
+import atexit
+import logging
+import threading
+import time
+from concurrent.futures import Future
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+# Batching of the encoder forward passes and of the decoder steps of several sessions that share one
+# model, e.g. in the server.
+
+def close_batcher(batcher):
+    '''Stops the thread of the batcher and fails the requests that wait for it. It's called at exit: torch
+    may abort the process when it's finalized while the daemon thread is alive.'''
+    with batcher.cond:
+        batcher.closed = True
+        pending, batcher.pending = batcher.pending, []
+        batcher.cond.notify_all()
+    for request in pending:
+        request[-1].set_exception(RuntimeError("The batcher is closed."))
+    batcher.thread.join()
+
+
+class EncoderBatcher:
+    """Runs the encoder forward passes requested by several sessions as one batch.
+
+    Every session calls encode() from its own thread and waits for the result. The first request
+    opens a time window of `window` seconds. The requests that arrive within the window are put into
+    batches of up to max_batch rows, and each caller gets its own row of the encoder output.
+
+    With --encoder_bucket, the sessions have different encoder input lengths. A batch runs over the
+    longest of them: the shorter inputs are extended by their own mel of the zero padding, as with a
+    larger bucket, and each encoder output is cut back to the caller's length.
+
+    The encoder runs in the eager mode, so it's not used with --compile. The decoder steps are batched
+    by DecoderBatcher.
+    """
+
+    def __init__(self, encoder, window=0.02, max_batch=8):
+        self.encoder = encoder
+        self.window = window
+        self.max_batch = max_batch
+
+        self.cond = threading.Condition()
+        self.pending = []  # (mel, n_frames, future)
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, name="encoder-batcher", daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def encode(self, mel, n_frames):
+        """mel: 1*n_mels*(at least 3000) frames, the log-mel with the zero padding, as from IncrementalLogMel.log_mel.
+        n_frames: the encoder input length of the caller, at most 3000.
+        Returns 1*(n_frames/2)*n_audio_state, the same as the encoder over mel[:, :, :n_frames], but with the context
+        of the zero padding up to the longest input of the batch."""
+        future = Future()
+        with self.cond:
+            if self.closed:
+                raise RuntimeError("The encoder batcher is closed.")
+            self.pending.append((mel, n_frames, future))
+            self.cond.notify()
+        return future.result()
+
+    def close(self):
+        close_batcher(self)
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.pending and not self.closed:
+                    self.cond.wait()
+                if self.closed:
+                    return
+                deadline = time.monotonic() + self.window
+                while len(self.pending) < self.max_batch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                requests, self.pending = self.pending, []
+            self._encode(requests)
+
+    @torch.no_grad()
+    def _encode(self, requests):
+        # the similar lengths go together, so that the shorter inputs are extended as little as possible
+        requests = sorted(requests, key=lambda r: r[1])
+        for beg in range(0, len(requests), self.max_batch):
+            batch = requests[beg:beg + self.max_batch]
+            n_frames = batch[-1][1]
+            logger.debug(f"encoder batch of {len(batch)}, {n_frames} frames")
+            try:
+                out = self.encoder(torch.cat([mel[:, :, :n_frames] for mel, _, _ in batch]))
+            except Exception as e:
+                for _, _, future in batch:
+                    future.set_exception(e)
+                continue
+            for i, (_, n, future) in enumerate(batch):
+                # the conv layers of the encoder halve the number of frames
+                future.set_result(out[i:i + 1, :n // 2])
+
+
+class DecoderBatcher:
+    """Runs the decoder steps of one token per sequence of several sessions as one batch.
+
+    The sessions keep their sequences in the rows of one KVCache, each with its own length, see
+    new_kv_cache. In its decoding loop, a session runs the first forward over the prompt alone, and
+    then every step of one token by step(), from its own thread, and it waits for the result. The steps
+    of the sessions run together by TextDecoder.batch_step, every row at its own position, and each
+    session gets the logits and the cross-attention of its own rows. The AlignAtt stopping, the rewinds
+    and the end of the sequences are decided by the decoding loop of each session. When it stops, the
+    session calls end() and the next batches go on without it.
+
+    A batch runs when all the sessions in their decoding loops have requested their next step, when
+    max_batch steps are requested, or `window` seconds after the first request.
+
+    model: Whisper, shared by the sessions, in the eager mode, so it's not used with --compile
+    n_rows: the number of the rows of the shared KVCache, the beams of all the sessions together
+    """
+
+    def __init__(self, model, n_rows, window=0.02, max_batch=8):
+        self.model = model
+        self.kv_cache = model.new_kv_cache(n_batch=n_rows)
+        self.used_rows = 0
+        self.window = window
+        self.max_batch = max_batch
+
+        self.cond = threading.Condition()
+        self.pending = []  # (tokens, audio_features, kv_cache, qk_layers, future)
+        self.active = set()  # the kv caches of the sessions in their decoding loops
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, name="decoder-batcher", daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def new_kv_cache(self, n_batch):
+        """The KVCache of a new session, n_batch rows of the shared one. The rows are not returned,
+        the sessions are reused for the next connections."""
+        with self.cond:
+            beg = self.used_rows
+            if beg + n_batch > self.kv_cache.row_index.shape[0]:
+                raise RuntimeError(f"All the {self.kv_cache.row_index.shape[0]} rows of the decoder batches are used.")
+            self.used_rows += n_batch
+        return self.kv_cache.rows(beg, n_batch)
+
+    def step(self, tokens, audio_features, kv_cache, qk_layers=()):
+        """The same as TextDecoder.forward_with_attention of one token per sequence, in a batch with
+        the other sessions. It also moves the length of kv_cache.
+        tokens: n_batch*1, the last token of every sequence. The previous ones are in kv_cache, from new_kv_cache.
+        audio_features: 1*n_audio_ctx*n_audio_state, the encoder output of the session"""
+        if kv_cache.parent is not self.kv_cache:
+            raise ValueError("The KV cache is not from new_kv_cache of this batcher.")
+        future = Future()
+        with self.cond:
+            if self.closed:
+                raise RuntimeError("The decoder batcher is closed.")
+            self.active.add(kv_cache)
+            self.pending.append((tokens, audio_features, kv_cache, tuple(qk_layers), future))
+            self.cond.notify()
+        return future.result()
+
+    def end(self, kv_cache):
+        """The decoding loop of the session of kv_cache stopped, the next batches don't wait for it"""
+        with self.cond:
+            self.active.discard(kv_cache)
+            self.cond.notify()
+
+    def close(self):
+        close_batcher(self)
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.pending and not self.closed:
+                    self.cond.wait()
+                if self.closed:
+                    return
+                deadline = time.monotonic() + self.window
+                # every session in the decoding loop has at most one step pending
+                while len(self.pending) < min(len(self.active), self.max_batch):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                requests, self.pending = self.pending[:self.max_batch], self.pending[self.max_batch:]
+            self._step(requests)
+
+    @torch.no_grad()
+    def _step(self, requests):
+        decoder = self.model.decoder
+        for request in list(requests):
+            kv_cache, future = request[2], request[4]
+            if kv_cache.length >= kv_cache.n_ctx:
+                future.set_exception(ValueError(f"KV cache overflow: {kv_cache.length + 1} > {kv_cache.n_ctx} tokens"))
+                requests.remove(request)
+        if not requests:
+            return
+        logger.debug(f"decoder batch of {len(requests)}")
+        try:
+            groups = [tokens.shape[0] for tokens, _, _, _, _ in requests]
+            tokens = torch.cat([tokens for tokens, _, _, _, _ in requests])
+            rows = torch.cat([kv_cache.row_index for _, _, kv_cache, _, _ in requests])
+            positions = torch.tensor([kv_cache.length for n, (_, _, kv_cache, _, _) in zip(groups, requests) for _ in range(n)],
+                                     device=tokens.device)
+            self_kv = [(self.kv_cache.self_attn[block.attn.key.cache_id], self.kv_cache.self_attn[block.attn.value.cache_id])
+                       for block in decoder.blocks]
+            cross_kv = [[kv_cache.cross_attention_kv(block.cross_attn, audio_features)
+                         for _, audio_features, kv_cache, _, _ in requests] for block in decoder.blocks]
+            qk_layers = set().union(*(layers for _, _, _, layers, _ in requests))
+            logits, cross_qk = decoder.batch_step(tokens, rows, positions, self_kv, cross_kv, groups, qk_layers)
+        except Exception as e:
+            for _, _, _, _, future in requests:
+                future.set_exception(e)
+            return
+
+        beg = 0
+        for i, (_, _, kv_cache, layers, future) in enumerate(requests):
+            kv_cache.advance(1)
+            future.set_result((logits[beg:beg + groups[i]], {layer: cross_qk[layer][i] for layer in layers}))
+            beg += groups[i]
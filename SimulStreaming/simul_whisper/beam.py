@@ -3,15 +3,13 @@ from .whisper.decoding import PyTorchInference
 # extention of PyTorchInference for beam search
 class BeamPyTorchInference(PyTorchInference):
 
-    def _kv_modules(self):
-        key_modules = [block.attn.key.cache_id for block in self.model.decoder.blocks]
-        value_modules = [block.attn.value.cache_id for block in self.model.decoder.blocks]
-        return key_modules + value_modules
-
     def rearrange_kv_cache(self, source_indices):
-        if source_indices != list(range(len(source_indices))):
-            for module_cache_id in self._kv_modules():
-                self.kv_cache[module_cache_id] = self.kv_cache[module_cache_id][source_indices].detach()
+        # self.kv_cache is the preallocated KVCache of PaddedAlignAttWhisper, reordered in place
+        self.kv_cache.reorder(source_indices)
     from torch import Tensor
     def logits(self, tokens: Tensor, audio_features: Tensor) -> Tensor:
-        return self.model.decoder(tokens, audio_features, kv_cache=self.kv_cache)
\ No newline at end of file
+        return self.model.decoder(tokens, audio_features, kv_cache=self.kv_cache)
+
+    def logits_with_attention(self, tokens: Tensor, audio_features: Tensor, qk_layers):
+        '''the logits and the cross-attention logits of qk_layers, see TextDecoder.forward_with_attention'''
+        return self.model.decoder.forward_with_attention(tokens, audio_features, self.kv_cache, qk_layers)
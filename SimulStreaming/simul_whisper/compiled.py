@@ -0,0 +1,95 @@
+import logging
+import os
+import time
+
+import torch
+import torch._dynamo.config
+import torch._inductor.config
+
+logger = logging.getLogger(__name__)
+
+# torch.compile of the encoder and of the single-token decoder step, for --compile.
+
+class CompiledDecoding:
+    """The compiled encoder and decoder step of a Whisper model.
+
+    The encoder is compiled for every encoder input length, i.e. for 30s, or for each multiple of
+    --encoder_bucket. The decoding loop runs the decoder for one token per sequence, except the first
+    forward over the prompt. These steps go to TextDecoder.step, which has the same shapes at every
+    position: it writes to the preallocated self-attention caches of KVCache and attends to all of
+    them with a mask. So it's compiled once per encoder input length and batch size. The forwards
+    over more tokens run in eager mode.
+
+    The shapes are static, so the number of the compiled graphs is known and the recompilation limit
+    of torch._dynamo is raised to it. The compiled kernels are cached on disk by torch inductor,
+    in cache_dir, or in its default directory. A restarted process compiles the same shapes faster,
+    from the cache.
+
+    model: Whisper, shared with the eager code
+    encoder_input_lens: all the numbers of mel frames the encoder runs over
+    """
+
+    def __init__(self, model, encoder_input_lens, cache_dir=None):
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            os.environ["TORCHINDUCTOR_CACHE_DIR"] = os.path.abspath(cache_dir)
+        if hasattr(torch._inductor.config, "fx_graph_cache"):
+            torch._inductor.config.fx_graph_cache = True
+
+        self.model = model
+        self.encoder_input_lens = sorted(set(encoder_input_lens))
+        # a graph per encoder input length, and some spare ones, e.g. for other batch sizes
+        n_graphs = len(self.encoder_input_lens) + 4
+        # cache_size_limit is the name in older torch, newer torch keeps it as an alias of recompile_limit
+        if torch._dynamo.config.cache_size_limit < n_graphs:
+            torch._dynamo.config.cache_size_limit = n_graphs
+
+        self.encoder = torch.compile(model.encoder, dynamic=False)
+        self.step = torch.compile(model.decoder.step, dynamic=False, fullgraph=True)
+
+    def logits_with_attention(self, tokens, audio_features, kv_cache, qk_layers=()):
+        '''The same as TextDecoder.forward_with_attention with kv_cache, which must be KVCache'''
+        self_kv = self.self_kv(kv_cache, tokens.shape[0])
+        if tokens.shape[1] != 1 or self_kv is None:
+            return self.model.decoder.forward_with_attention(tokens, audio_features, kv_cache, qk_layers)
+        if kv_cache.length >= kv_cache.n_ctx:
+            raise ValueError(f"KV cache overflow: {kv_cache.length + 1} > {kv_cache.n_ctx} tokens")
+
+        cross_kv = [kv_cache.cross_attention_kv(block.cross_attn, audio_features) for block in self.model.decoder.blocks]
+        position = torch.tensor([kv_cache.length], device=tokens.device)
+        # tokens is a view of the last column of the sequences, its strides change with their length,
+        # which would be a recompilation
+        tokens = tokens.new_empty(tokens.shape).copy_(tokens)
+        logits, cross_qk = self.step(tokens, position, self_kv, cross_kv, tuple(sorted(qk_layers)))
+        kv_cache.advance(1)
+        return logits, cross_qk
+
+    def self_kv(self, kv_cache, n_batch):
+        '''The self-attention caches of kv_cache per layer, or None if they are not for n_batch sequences'''
+        self_kv = []
+        for block in self.model.decoder.blocks:
+            k = kv_cache.self_attn[block.attn.key.cache_id]
+            v = kv_cache.self_attn[block.attn.value.cache_id]
+            if k.shape[0] != n_batch:
+                return None
+            self_kv.append((k, v))
+        return self_kv
+
+    @torch.no_grad()
+    def warmup(self, n_batch, qk_layers=()):
+        '''Compiles the encoder and the decoder step for all the encoder input lengths, so that it doesn't
+        happen while processing the audio. Returns the time it took in seconds.'''
+        start = time.time()
+        device = self.model.device
+        kv_cache = self.model.new_kv_cache(n_batch=n_batch)
+        for n_frames in self.encoder_input_lens:
+            logger.info(f"compiling the encoder and the decoder step for {n_frames} mel frames")
+            mel = torch.zeros(1, self.model.dims.n_mels, n_frames, device=device)
+            # one encoder output for all the sequences, as in the decoding loop
+            audio_features = self.encoder(mel)
+            kv_cache.reset()
+            tokens = torch.zeros(n_batch, 1, dtype=torch.long, device=device)
+            self.logits_with_attention(tokens, audio_features, kv_cache, qk_layers)
+        duration = time.time() - start
+        logger.info(f"compilation done in {duration:.2f} s")
+        return duration
@@ -27,5 +27,17 @@ class AlignAttConfig(SimulWhisperConfig):
     frame_threshold: int = 4
     rewind_threshold: int = 200 # in frames. Max value is 1500. Higher value turns rewinds off.
     audio_max_len: float = 30.0
+    encoder_bucket: float = field(default=None, metadata={"help": "If set, the encoder runs only over the audio content "
+                                  "rounded up to a multiple of this length in seconds, instead of over the 30s padded input."})
     cif_ckpt_path: str = ""
+    draft_model_path: str = field(default=None, metadata={"help": "A smaller Whisper model that proposes the tokens "
+                                  "for the greedy decoding, the main model verifies them. The output is the same."})
+    draft_tokens: int = 4
+    sdpa: bool = field(default=True, metadata={"help": "Fused scaled_dot_product_attention in the attention modules "
+                       "that are not needed for the alignment heads."})
+    int8: bool = field(default=False, metadata={"help": "Dynamic int8 quantization of the linear layers of the models, "
+                       "for inference on CPU."})
+    compile: bool = field(default=False, metadata={"help": "torch.compile of the encoder and of the single-token decoder step."})
+    compile_cache_dir: str = field(default=None, metadata={"help": "Directory of the compiled kernels, reused after restart. "
+                                   "If None, the default directory of torch inductor."})
     never_fire: bool = False
\ No newline at end of file
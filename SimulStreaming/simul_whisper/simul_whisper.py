@@ -8,11 +8,13 @@ import torch.nn.functional as F
 
 from .whisper import load_model, DecodingOptions, tokenizer
 from .config import AlignAttConfig
-from .whisper.audio import log_mel_spectrogram, TOKENS_PER_SECOND, pad_or_trim, N_SAMPLES, N_FRAMES
-from .whisper.timing import median_filter
-from .whisper.decoding import GreedyDecoder, BeamSearchDecoder, SuppressTokens, detect_language
+from .whisper.audio import IncrementalLogMel, TOKENS_PER_SECOND, FRAMES_PER_SECOND, pad_or_trim, N_SAMPLES, N_FRAMES
+from .whisper.decoding import GreedyDecoder, BeamSearchDecoder, detect_language
 from .beam import BeamPyTorchInference
 from .eow_detection import fire_at_boundary, load_cif
+from .alignment_attention import AlignmentAttention
+from .speculative import SpeculativeDecoding
+from .compiled import CompiledDecoding
 import os
 
 from token_buffer import TokenBuffer
@@ -26,6 +28,18 @@ logger = logging.getLogger(__name__)
 import sys
 import wave
 
+def load_whisper(model_path, int8=False):
+    '''Loads the Whisper model from model_path. If it's not there, a model with the same name is downloaded to its directory.
+    int8: the model is loaded to CPU and its linear layers are quantized dynamically to int8'''
+    name = os.path.basename(model_path).replace(".pt", "")
+    download_root = os.path.dirname(os.path.abspath(model_path))
+    if not int8:
+        return load_model(name=name, download_root=download_root)
+    if torch.cuda.is_available():
+        logger.warning("The int8 quantized model runs on CPU, not on the available GPU.")
+    model = load_model(name=name, download_root=download_root, device="cpu")
+    return model.quantize_dynamic()
+
 # New features added to the original version of Simul-Whisper: 
 # - large-v3 model support
 # - translation support
@@ -33,14 +47,22 @@ import wave
 # - prompt -- static vs. non-static
 # - context
 class PaddedAlignAttWhisper:
-    def __init__(self, cfg: AlignAttConfig) -> None:
+    def __init__(self, cfg: AlignAttConfig, model=None, draft_model=None, compiled=None) -> None:
+        '''model: the loaded Whisper model to share with another instance, e.g. for another session
+        of the server. Only the weights are shared, the state of processing is in each instance.
+        If None, it is loaded from cfg.model_path.
+        draft_model: the same for the draft model of the speculative decoding. If None, it is loaded
+        from cfg.draft_model_path, if set.
+        compiled: the CompiledDecoding of the shared model, with cfg.compile. If None, it is created.'''
         self.logdir_i = 0
         self.log_segments = 0
         if cfg.logdir is not None and not os.path.exists(cfg.logdir):
             os.makedirs(cfg.logdir)
         model_name = os.path.basename(cfg.model_path).replace(".pt", "")
-        model_path = os.path.dirname(os.path.abspath(cfg.model_path))
-        self.model = load_model(name=model_name, download_root=model_path)
+        if model is None:
+            self.model = load_whisper(cfg.model_path, int8=cfg.int8)
+        else:
+            self.model = model
 
         logger.info(f"Model dimensions: {self.model.dims}")
 
@@ -62,30 +84,8 @@ class PaddedAlignAttWhisper:
                                                                      n_audio_state=self.model.dims.n_audio_state,
                                                                      device=self.model.device)
 
-        # install hooks to access encoder-decoder attention
-        self.dec_attns = []
-        def layer_hook(module, net_input, net_output):
-            # net_output[1]: B*num_head*token_len*audio_len
-            t = F.softmax(net_output[1], dim=-1)
-            self.dec_attns.append(t.squeeze(0))
-        for b in self.model.decoder.blocks:
-            b.cross_attn.register_forward_hook(layer_hook)
-        
-        self.kv_cache = {}
-        def kv_hook(module: torch.nn.Linear, _, net_output: torch.Tensor):
-            if module.cache_id not in self.kv_cache or net_output.shape[1] > self.max_text_len:
-                # save as-is, for the first token or cross attention
-                self.kv_cache[module.cache_id] = net_output
-            else:
-                x = self.kv_cache[module.cache_id]
-                self.kv_cache[module.cache_id] = torch.cat([x, net_output], dim=1).detach()
-            return self.kv_cache[module.cache_id] 
-
-        for i,b in enumerate(self.model.decoder.blocks):
-            b.attn.key.register_forward_hook(kv_hook)
-            b.attn.value.register_forward_hook(kv_hook)
-            b.cross_attn.key.register_forward_hook(kv_hook)
-            b.cross_attn.value.register_forward_hook(kv_hook)
+        # preallocated for all beams and max_text_len tokens, reused across infer calls
+        self.kv_cache = self.model.new_kv_cache(n_batch=cfg.beam_size)
 
         self.align_source = {}
         self.num_align_heads = 0
@@ -96,27 +96,29 @@ class PaddedAlignAttWhisper:
             self.align_source[layer_rank] = heads
             self.num_align_heads += 1
 
+        # the encoder-decoder attention of the layers with alignment heads is returned by the decoder
+        # forward, see logits(). The other attention modules use the fused attention. No hooks are
+        # installed, so the model weights can be shared by several instances, e.g. sessions of the server.
+        self.align_attn = AlignmentAttention(self.align_source, self.num_align_heads)
+        self.model.set_attention_backend(use_sdpa=cfg.sdpa)
 
-        # tokens to be suppressed from decoding, to prevent hallucinations
-        suppress_tokens = [
-                self.tokenizer.transcribe,
-                self.tokenizer.translate,
-                self.tokenizer.sot,
-                self.tokenizer.sot_prev,
-                self.tokenizer.sot_lm,
-                # self.tokenizer.eot 
-                self.tokenizer.no_timestamps,  # added by DM
-            ] + list(self.tokenizer.all_language_tokens)  # added by DM
-        if self.tokenizer.no_speech is not None:
-            suppress_tokens.append(self.tokenizer.no_speech)
-        suppress_tokens =  tuple(sorted(set(suppress_tokens)))
-        logger.debug(f"Suppress tokens: {suppress_tokens}")
-        sup_tokens = SuppressTokens(suppress_tokens)
-        self.suppress_tokens = lambda logits: sup_tokens.apply(logits, None)
-        # blank tokens are suppresed for new segments near the line 334
+
+        # the masks of the suppressed tokens are made in create_tokenizer
 
         # it's going to be regenerated after lang id
-        self.segments = []
+        # lengths of the audio segments in samples. The audio itself is only in self.mel_cache.buffer.
+        self.segment_lens = []
+        # samples appended by append_audio after the last segment, they become a segment in insert_audio
+        self.pending_len = 0
+        # log-mel frames of the audio segments, computed incrementally, and the preallocated audio buffer
+        self.mel_cache = IncrementalLogMel(n_mels=self.model.dims.n_mels, device=self.model.device,
+                                           capacity=2*int(cfg.audio_max_len*16000))
+        # encoder output and content_mel_len of the audio segments, while they do not change
+        self.encoded = None
+        # EncoderBatcher and DecoderBatcher shared with other instances of the same model, or None to run
+        # alone, see use_batchers
+        self.encoder_batcher = None
+        self.decoder_batcher = None
         self.init_tokens()
         
         self.last_attend_frame = -self.cfg.rewind_threshold
@@ -140,6 +142,35 @@ class PaddedAlignAttWhisper:
 
             self.token_decoder = BeamSearchDecoder(inference=self.inference, eot=self.tokenizer.eot, beam_size=cfg.beam_size)
 
+        # the draft model proposes the next tokens for the greedy decoder, see SpeculativeDecoding
+        self.speculative = None
+        if draft_model is None and cfg.draft_model_path is not None:
+            draft_model = load_whisper(cfg.draft_model_path, int8=cfg.int8)
+        if draft_model is not None:
+            if self.decoder_type != "greedy":
+                raise ValueError("The draft model can be used only with the greedy decoder.")
+            logger.info(f"Draft model dimensions: {draft_model.dims}")
+            draft_model.set_attention_backend(use_sdpa=cfg.sdpa)
+            self.speculative = SpeculativeDecoding(self.model, self.kv_cache, self.align_attn, draft_model,
+                                                   self.suppress_tokens, self.tokenizer.eot, n_draft=cfg.draft_tokens)
+
+        # the compiled encoder and single-token decoder step, or None for eager mode
+        self.compiled = compiled
+        if cfg.compile and compiled is None:
+            encoder_input_lens = [self.encoder_input_len(frames) for frames in range(N_FRAMES + 1)]
+            self.compiled = CompiledDecoding(self.model, encoder_input_lens, cache_dir=cfg.compile_cache_dir)
+
+    def use_batchers(self, encoder_batcher, decoder_batcher):
+        '''The encoder forwards and the decoder steps of one token run in batches with the other instances
+        of the same model, see simul_whisper/batching.py. The kv cache becomes rows of the shared one.'''
+        self.encoder_batcher = encoder_batcher
+        self.decoder_batcher = decoder_batcher
+        self.kv_cache = decoder_batcher.new_kv_cache(self.cfg.beam_size)
+        if self.decoder_type == "beam":
+            self.inference.kv_cache = self.kv_cache
+        if self.speculative is not None:
+            self.speculative.kv_cache = self.kv_cache
+
     def create_tokenizer(self, language=None):
         self.tokenizer = tokenizer.get_tokenizer(
             multilingual=self.tokenizer_is_multilingual,  
@@ -147,6 +178,40 @@ class PaddedAlignAttWhisper:
             num_languages=self.model.num_languages,
             task=self.decode_options.task
         )
+        self.create_token_masks()
+
+    def create_token_masks(self):
+        '''Boolean masks over the vocabulary, on the device of the model, for masked_fill_ of the logits.
+        They depend on the tokenizer, so they are made again with it.'''
+        # tokens to be suppressed from decoding, to prevent hallucinations
+        suppress_tokens = [
+                self.tokenizer.transcribe,
+                self.tokenizer.translate,
+                self.tokenizer.sot,
+                self.tokenizer.sot_prev,
+                self.tokenizer.sot_lm,
+                # self.tokenizer.eot 
+                self.tokenizer.no_timestamps,  # added by DM
+            ] + list(self.tokenizer.all_language_tokens)  # added by DM
+        if self.tokenizer.no_speech is not None:
+            suppress_tokens.append(self.tokenizer.no_speech)
+        suppress_tokens =  tuple(sorted(set(suppress_tokens)))
+        logger.debug(f"Suppress tokens: {suppress_tokens}")
+
+        def token_mask(tokens, value=True):
+            mask = torch.full((self.model.dims.n_vocab,), not value, dtype=torch.bool)
+            mask[list(tokens)] = value
+            return mask.to(self.model.device)
+
+        self.suppress_mask = token_mask(suppress_tokens)
+        # blank tokens are suppressed at the beginning of a segment
+        self.blank_mask = token_mask(self.tokenizer.encode(" ") + [self.tokenizer.eot])
+        # all but the language tokens, for lang_id
+        self.non_language_mask = token_mask(self.tokenizer.all_language_tokens, value=False)
+
+    def suppress_tokens(self, logits):
+        '''suppresses the tokens in logits (n_batch * n_vocab) in place'''
+        logits.masked_fill_(self.suppress_mask, -np.inf)
 
     def init_context(self):
         kw = {'tokenizer': self.tokenizer, 
@@ -155,11 +220,13 @@ class PaddedAlignAttWhisper:
         self.context = TokenBuffer.empty(**kw)
         if self.cfg.static_init_prompt is not None:
             self.context = TokenBuffer.from_text(self.cfg.static_init_prompt, **kw)
+        # the tokens of the static prompt are never trimmed
+        self.static_prompt_len = len(self.context)
         if self.cfg.init_prompt is not None:
-            self.context.text += self.cfg.init_prompt
+            self.context.append_text(self.cfg.init_prompt)
 
     def init_tokens(self):
-        logger.debug(f"init tokens, {len(self.segments)}")
+        logger.debug(f"init tokens, {len(self.segment_lens)}")
         # init tokens (mandatory prompt)
         self.initial_tokens = torch.tensor(
             self.tokenizer.sot_sequence_including_notimestamps, 
@@ -168,21 +235,18 @@ class PaddedAlignAttWhisper:
         self.initial_token_length = self.initial_tokens.shape[1]
         self.sot_index = self.tokenizer.sot_sequence.index(self.tokenizer.sot)
 #        self.segments = []
-        logger.debug(f"init tokens after, {len(self.segments)}")
+        logger.debug(f"init tokens after, {len(self.segment_lens)}")
         self.tokens = [self.initial_tokens]
 
     def trim_context(self):
         logger.info("Trimming context")
-        c = len(self.context.as_token_ids()) - len(self.context.prefix_token_ids)
+        c = len(self.context)
 #        logger.debug(f"c= {len(self.context.as_token_ids())}, {len(self.context.prefix_token_ids)}")
         logger.info(f"Context text: {self.context.as_text()}")
 #        logger.debug(f"Context tensor: {self.context.as_tensor()}")
         l = sum(t.shape[1] for t in self.tokens) + c
 #        logger.debug(f"len {l}, c {c}, max_context_tokens {self.max_context_tokens}")
-        if self.cfg.static_init_prompt is None:
-            after = 0
-        else:
-            after = len(self.cfg.static_init_prompt)
+        after = self.static_prompt_len
 #        logger.debug(f"len {l}, c {c}, max_context_tokens {self.max_context_tokens}")
         while c > self.max_context_tokens or l > self.max_text_len - 20:
             t = self.context.trim_words(after=after)
@@ -196,11 +260,19 @@ class PaddedAlignAttWhisper:
 
 
     def logits(self, tokens: torch.Tensor, audio_features: torch.Tensor) -> torch.Tensor:
-        if self.cfg.decoder_type == "greedy":
-            logit = self.model.decoder(tokens, audio_features, kv_cache=self.kv_cache)
+        '''the decoder forward with kv_cache. The cross-attention of the alignment heads goes to align_attn.'''
+        if self.decoder_batcher is not None and tokens.shape[1] == 1:
+            # one token per sequence, in a batch with the steps of the other instances
+            logit, cross_qk = self.decoder_batcher.step(tokens, audio_features, self.kv_cache, self.align_source)
+        elif self.compiled is not None:
+            logit, cross_qk = self.compiled.logits_with_attention(tokens, audio_features, self.kv_cache, self.align_source)
+        elif self.cfg.decoder_type == "greedy":
+            logit, cross_qk = self.model.decoder.forward_with_attention(tokens, audio_features, self.kv_cache, self.align_source)
         else:
             logger.debug(f"Logits shape: {tokens.shape}")
-            logit = self.inference.logits(tokens, audio_features)
+            logit, cross_qk = self.inference.logits_with_attention(tokens, audio_features, self.align_source)
+        for layer_rank, qk in cross_qk.items():
+            self.align_attn.add(layer_rank, qk)
         return logit
     
 
@@ -212,12 +284,16 @@ class PaddedAlignAttWhisper:
         self.detected_language = None
         self.init_context()
         logger.debug(f"Context: {self.context}")
-        if not complete and len(self.segments) > 2:
+        if not complete and len(self.segment_lens) > 2:
             logger.debug("keeping last two segments because they are and it is not complete.")
-            self.segments = self.segments[-2:]
+            self.mel_cache.drop(sum(self.segment_lens[:-2]))
+            self.segment_lens = self.segment_lens[-2:]
         else:
             logger.debug("removing all segments.")
-            self.segments = []
+            self.segment_lens = []
+            self.pending_len = 0
+            self.mel_cache.reset()
+        self.encoded = None
         self.log_segments += 1
 
 
@@ -255,7 +331,7 @@ class PaddedAlignAttWhisper:
     ### audio buffer 
 
     def segments_len(self):
-        segments_len = sum(s.shape[0] for s in self.segments) / 16000
+        segments_len = sum(self.segment_lens) / 16000
         return segments_len
 
     def _apply_minseglen(self):
@@ -266,33 +342,74 @@ class PaddedAlignAttWhisper:
             return False
         return True
 
+    def append_audio(self, audio):
+        '''Writes audio to the end of the buffer. It becomes a part of the segment that is closed by the next insert_audio.'''
+        if audio.shape[0] == 0:
+            return
+        self.mel_cache.append(audio)
+        self.pending_len += audio.shape[0]
+        self.encoded = None
+
     def insert_audio(self, segment=None):
+        '''Appends the segment, if any, closes the segment from append_audio, and removes the first segments
+        over audio_max_len. Returns the length of the removed segment in seconds, or 0.'''
+        return self.drop_context(self.close_segment(segment))
+
+    def close_segment(self, segment=None):
+        '''The audio part of insert_audio: appends the segment, if any, closes the segment from append_audio,
+        and removes the first segments over audio_max_len from the audio buffer. The tokens and context are
+        not changed. Returns the lengths of the removed segments in samples, for drop_context.'''
         if segment is not None:
-            self.segments.append(segment)
+            self.append_audio(segment)
+        if self.pending_len > 0:
+            self.segment_lens.append(self.pending_len)
+            self.pending_len = 0
 
-        removed_len = 0
+        removed = []
         # len of audio is bigger than buffer_len. Going to remove the first segment
         segments_len = self.segments_len()
-        while len(self.segments) > 1 and segments_len > self.cfg.audio_max_len:
-            removed_len = self.segments[0].shape[0] / 16000
-            segments_len -= removed_len
+        while len(self.segment_lens) > 1 and segments_len > self.cfg.audio_max_len:
+            removed.append(self.segment_lens[0])
+            segments_len -= self.segment_lens[0] / 16000
+            self.mel_cache.drop(self.segment_lens[0])
+            self.segment_lens = self.segment_lens[1:]
+            self.encoded = None
+            logger.debug(f"remove segments: {len(self.segment_lens)}")
+        return removed
+
+    def drop_context(self, removed):
+        '''The text part of insert_audio: the tokens of the segments removed by close_segment go to the context.
+        Returns the length of the last removed segment in seconds, or 0.'''
+        removed_len = 0
+        for segment_len in removed:
+            removed_len = segment_len / 16000
             self.last_attend_frame -= int(TOKENS_PER_SECOND*removed_len)
-            self.segments = self.segments[1:]
-            logger.debug(f"remove segments: {len(self.segments)} {len(self.tokens)}")
+            logger.debug(f"remove segment tokens: {len(self.tokens)}")
             if len(self.tokens) > 1:
                 self.context.append_token_ids(self.tokens[1][0,:])
                 self.tokens = [self.initial_tokens] + self.tokens[2:]
         return removed_len
 
+    def encoder_input_len(self, content_frames):
+        '''The number of mel frames the encoder runs over: 3000 = 30s, or the content rounded up 
+        to a multiple of cfg.encoder_bucket, when it is set.'''
+        if self.cfg.encoder_bucket is None:
+            return N_FRAMES
+        bucket = int(round(self.cfg.encoder_bucket * FRAMES_PER_SECOND))
+        bucket += bucket % 2  # the second conv layer of the encoder has stride 2
+        bucket = max(bucket, 2)
+        return min(N_FRAMES, max(1, -(-content_frames // bucket)) * bucket)
+
     def _clean_cache(self):
         '''clean the cache that stores the attention matrices and kv_cache.
         It must be called every time after generation with the model.'''
-        # cleaning cache
-        self.dec_attns = []
-        self.kv_cache = {}
+        # cleaning cache. Cross-attention keys and values in kv_cache stay valid for the same encoder output.
+        self.align_attn.reset()
+        self.kv_cache.reset()
         if self.decoder_type == "beam":
-            self.inference.kv_cache = self.kv_cache
             self.token_decoder.reset()
+        if self.speculative is not None:
+            self.speculative.reset()
 
     @torch.no_grad()
     def lang_id(self, encoder_features):
@@ -303,12 +420,11 @@ class PaddedAlignAttWhisper:
         # forward pass using a single token, startoftranscript
         n_audio = encoder_features.shape[0]
         x = torch.tensor([[self.tokenizer.sot]] * n_audio).to(self.model.device)  # [n_audio, 1]
-        logits = self.model.logits(x, encoder_features)[:, 0]
+        # with kv_cache, the cross-attention keys and values are reused by the decoding that follows
+        logits = self.model.decoder(x, encoder_features, kv_cache=self.kv_cache)[:, 0]
 
         # collect detected languages; suppress all non-language tokens
-        mask = torch.ones(logits.shape[-1], dtype=torch.bool)
-        mask[list(self.tokenizer.all_language_tokens)] = False
-        logits[:, mask] = -np.inf
+        logits.masked_fill_(self.non_language_mask, -np.inf)
         language_tokens = logits.argmax(dim=-1)
         language_token_probs = logits.softmax(dim=-1).cpu()
         language_probs = [
@@ -329,38 +445,75 @@ class PaddedAlignAttWhisper:
 
     ### transcription / translation
 
+    def encode(self):
+        '''Returns the encoder output of the audio segments, the number of its frames with the actual audio,
+        and the encoder output of the draft model, or None without it. If the audio has not changed since the last call, e.g. in finish() after process_iter(), the same encoder
+        output is returned, so that also the cross-attention keys and values in kv_cache are reused.
+        The audio from append_audio must be closed by close_segment before, the mel is computed from the whole buffer.'''
+        assert self.pending_len == 0, f"{self.pending_len} samples of audio are not in a segment, call close_segment() first"
+        if self.encoded is not None:
+            logger.debug("audio has not changed, reusing the encoder output")
+            return self.encoded
+
+        # mel + padding to 30s, only the frames of new audio are computed
+        mel_padded = self.mel_cache.log_mel(padding=N_SAMPLES).unsqueeze(0)
+        # trim to 3000, or only to the content rounded up to the encoder bucket
+        n_frames = self.encoder_input_len(mel_padded.shape[2] - N_FRAMES)
+        mel = pad_or_trim(mel_padded, n_frames)
+
+        # the len of actual audio
+        content_mel_len = int((mel_padded.shape[2] - N_FRAMES)/2)
+
+        # encode
+        if self.encoder_batcher is None:
+            encoder = self.model.encoder if self.compiled is None else self.compiled.encoder
+            encoder_feature = encoder(mel)
+        else:
+            # a batch may run over a longer input of another session, also padded by zeros
+            encoder_feature = self.encoder_batcher.encode(mel_padded, n_frames)
+        draft_feature = None
+        if self.speculative is not None:
+            draft_feature = self.speculative.draft_model.encoder(mel)
+        self.encoded = (encoder_feature, content_mel_len, draft_feature)
+        return self.encoded
+
     @torch.no_grad()
-    def infer(self, is_last=False):
-        new_segment = True
-        if len(self.segments) == 0:
+    def encode_segments(self):
+        '''The encoder stage of infer. Returns (encoded, audio): the output of encode(), or None when there is
+        nothing to decode yet, and a copy of the audio for logdir_save, or None without logdir.
+        It doesn't touch the tokens, context nor kv_cache, so it can run in another thread while infer()
+        decodes the previous segments. See SimulWhisperOnline.prepare for the order of the calls.'''
+        audio = None
+        if self.cfg.logdir is not None:
+            audio = self.mel_cache.audio[:sum(self.segment_lens)].cpu().numpy()
+        if len(self.segment_lens) == 0:
             logger.debug("No segments, nothing to do")
-            self.logdir_save([], [], {})
-            return [], {}
+            return None, audio
         if not self._apply_minseglen():
             logger.debug(f"applied minseglen {self.cfg.audio_min_len} > {self.segments_len()}.")
-            input_segments = torch.cat(self.segments, dim=0)
-            self.logdir_save(input_segments, [], {})
-            return [], {}
+            return None, audio
+        return self.encode(), audio
 
-        # input_segments is concatenation of audio, it's one array
-        if len(self.segments) > 1:
-            input_segments = torch.cat(self.segments, dim=0)
-        else:
-            input_segments = self.segments[0]
-
-
-        
-        # mel + padding to 30s
-        mel_padded = log_mel_spectrogram(input_segments, n_mels=self.model.dims.n_mels, padding=N_SAMPLES, 
-                                            device=self.model.device).unsqueeze(0)
-        # trim to 3000
-        mel = pad_or_trim(mel_padded, N_FRAMES)
-
-        # the len of actual audio
-        content_mel_len = int((mel_padded.shape[2] - mel.shape[2])/2)
+    @torch.no_grad()
+    def infer(self, is_last=False, encoded=None):
+        '''encoded: the output of encode_segments() when it ran before, e.g. in another thread. Otherwise,
+        it's called here.'''
+        if encoded is None:
+            encoded = self.encode_segments()
+        try:
+            return self._infer(is_last, *encoded)
+        finally:
+            if self.decoder_batcher is not None:
+                # the decoding loop stopped, also on an error, the batched steps of the others don't wait for it
+                self.decoder_batcher.end(self.kv_cache)
+
+    def _infer(self, is_last, encoded, audio):
+        new_segment = True
+        if encoded is None:
+            self.logdir_save(audio, [], {})
+            return [], {}
 
-        # encode
-        encoder_feature = self.model.encoder(mel)
+        encoder_feature, content_mel_len, draft_feature = encoded
 
 #        logger.debug(f"Encoder feature shape: {encoder_feature.shape}")
 #        if mel.shape[-2:] != (self.model.dims.n_audio_ctx, self.model.dims.n_audio_state):
@@ -386,10 +539,9 @@ class PaddedAlignAttWhisper:
         ####################### Decoding loop
         logger.info("Decoding loop starts\n")
 
-        sum_logprobs = torch.zeros(self.cfg.beam_size, device=mel.device)
+        sum_logprobs = torch.zeros(self.cfg.beam_size, device=encoder_feature.device)
         completed = False
 
-        attn_of_alignment_heads = None
         most_attended_frame = None
 
         token_len_before_decoding = current_tokens.shape[1]
@@ -421,7 +573,11 @@ class PaddedAlignAttWhisper:
                 # only need to use the last token except in the first forward pass
                 tokens_for_logits = current_tokens[:,-1:]
 
-            logits = self.logits(tokens_for_logits, encoder_feature) # B, len(tokens), token dict size
+            if self.speculative is not None and not new_segment:
+                # the same logits, from a forward over the tokens proposed by the draft model
+                logits = self.speculative.logits(current_tokens, encoder_feature, draft_feature, self.max_text_len)
+            else:
+                logits = self.logits(tokens_for_logits, encoder_feature) # B, len(tokens), token dict size
             if new_segment:
                 generation["logits_starting"] = Logits(logits[:,:,:])
 
@@ -439,7 +595,7 @@ class PaddedAlignAttWhisper:
 
             # supress blank tokens only at the beginning of the segment
             if new_segment:
-                logits[:, self.tokenizer.encode(" ") + [self.tokenizer.eot]] = -np.inf
+                logits.masked_fill_(self.blank_mask, -np.inf)
             new_segment = False
             self.suppress_tokens(logits)
             #generation_progress_loop.append(("logits_after_suppres",BeamLogits(logits[0,:].clone(), self.cfg.beam_size)))
@@ -466,35 +622,8 @@ class PaddedAlignAttWhisper:
 
             #     logger.debug("decode stopped because decoder completed")
 
-            attn_of_alignment_heads = [[] for _ in range(self.num_align_heads)]
-            for i, attn_mat in enumerate(self.dec_attns):
-                layer_rank = int(i % len(self.model.decoder.blocks))
-                align_heads_in_layer = self.align_source.get(layer_rank, [])
-                if len(align_heads_in_layer) == 0:
-                    continue
-                for align_head_rank, head_id in align_heads_in_layer:
-                    if self.cfg.beam_size == 1:
-                        a = attn_mat[head_id, :, :]
-                        a = a.unsqueeze(0)
-                    else:
-                        a = attn_mat[:, head_id, :, :]
-                    attn_of_alignment_heads[align_head_rank].append(a)
-            tmp = []
-            for mat in attn_of_alignment_heads:
-                t = torch.cat(mat, dim=1)
-                tmp.append(t) 
-            attn_of_alignment_heads = torch.stack(tmp, dim=1)
-#            logger.debug(str(attn_of_alignment_heads.shape) + " tttady")
-            std, mean = torch.std_mean(attn_of_alignment_heads, dim=-2, keepdim=True, unbiased=False)
-            attn_of_alignment_heads = (attn_of_alignment_heads - mean) / std
-            attn_of_alignment_heads = median_filter(attn_of_alignment_heads, 7) # from whisper.timing
-            attn_of_alignment_heads = attn_of_alignment_heads.mean(dim=1)
-#            logger.debug(str(attn_of_alignment_heads.shape) + " po mean")
-            attn_of_alignment_heads = attn_of_alignment_heads[:,:, :content_mel_len]
-#            logger.debug(str(attn_of_alignment_heads.shape) + " pak ")
-
             # for each beam, the most attended frame is:
-            most_attended_frames = torch.argmax(attn_of_alignment_heads[:,-1,:], dim=-1)
+            most_attended_frames = self.align_attn.most_attended_frames(content_mel_len)
             generation_progress_loop.append(("most_attended_frames",most_attended_frames.clone().tolist()))
             logger.debug(str(most_attended_frames.tolist()) + " most att frames")
 
@@ -532,8 +661,8 @@ class PaddedAlignAttWhisper:
         
             # debug print
             for i in range(self.cfg.beam_size):
-                logger.debug("attn: {}, current pos: {}, current token: {}({})".format(
-                    attn_of_alignment_heads.shape if attn_of_alignment_heads is not None else None,
+                logger.debug("attn rows: {}, current pos: {}, current token: {}({})".format(
+                    self.align_attn.count,
                     most_attended_frames[i], 
                     current_tokens[i, -1].item(),
                     self.tokenizer.decode([current_tokens[i, -1].item()])
@@ -550,6 +679,8 @@ class PaddedAlignAttWhisper:
         ####################### End of decoding loop
 
         logger.info("End of decoding loop")
+        if self.speculative is not None:
+            logger.debug(f"draft tokens accepted: {self.speculative.accepted} of {self.speculative.proposed}")
 
         # if attn_of_alignment_heads is not None:
         #     seg_len = int(segment.shape[0] / 16000 * TOKENS_PER_SECOND)
@@ -601,10 +732,10 @@ class PaddedAlignAttWhisper:
         
         self._clean_cache()
 
-        self.logdir_save(input_segments, new_hypothesis, generation)
+        self.logdir_save(audio, new_hypothesis, generation)
         return new_hypothesis, generation
 
-    def logdir_save(self, input_segments, new_hypothesis, generation):
+    def logdir_save(self, audio_np, new_hypothesis, generation):
         """The audio and result from each iteration is saved to the logdir for debugging purposes"""
 
         # only when the logdir arg is set
@@ -622,7 +753,6 @@ class PaddedAlignAttWhisper:
 
         # saving wav:
         wav_path = os.path.join(dir, f"iter_{self.logdir_i:05d}_audio.wav")
-        audio_np = np.array(input_segments)
         # Ensure audio is float32 in range [-1, 1], convert to int16 for wav
         if audio_np.dtype != np.int16:
             audio_int16 = np.clip(audio_np * 32767, -32768, 32767).astype(np.int16)
@@ -0,0 +1,100 @@
+import logging
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+# Speculative decoding for the greedy AlignAtt decoding loop: a small draft model proposes tokens and
+# the main model checks them in one decoder forward.
+
+class SpeculativeDecoding:
+    """Gives the logits of the main model for the next token of the greedy decoding, like a decoder
+    forward of the last token with kv_cache, but it runs the main decoder for several tokens at once.
+
+    When the logits of the last token are not ready, the draft model continues the tokens by up to
+    n_draft greedy tokens, and the main decoder runs over the last token and the draft tokens in one
+    forward. Its rows are then given one by one, as long as the decoding loop chooses the same tokens
+    as the draft model. At the first different token, the rest is discarded and kv_cache is rolled
+    back. The attention of the alignment heads is split per token in the same way, so the AlignAtt
+    policy checks every token as without the draft model.
+
+    model, kv_cache, align_attn: of the PaddedAlignAttWhisper instance
+    draft_model: a Whisper model with the same vocabulary and mel bins as model, e.g. tiny or base for small or medium
+    suppress_tokens: function that suppresses the tokens in logits in place, as in the decoding loop
+    """
+
+    def __init__(self, model, kv_cache, align_attn, draft_model, suppress_tokens, eot, n_draft=4):
+        if draft_model.dims.n_vocab != model.dims.n_vocab or draft_model.dims.n_mels != model.dims.n_mels:
+            raise ValueError("The draft model must have the same vocabulary and mel bins as the main model.")
+        self.model = model
+        self.kv_cache = kv_cache
+        self.align_attn = align_attn
+        self.draft_model = draft_model
+        self.draft_kv_cache = draft_model.new_kv_cache(n_batch=1)
+        self.suppress_tokens = suppress_tokens
+        self.eot = eot
+        self.n_draft = n_draft
+
+        self.reset()
+
+    def reset(self):
+        '''Starts a new sequence, it must be called with kv_cache.reset()'''
+        self.draft_tokens = []  # the tokens in draft_kv_cache
+        self.rows = []  # (input token, logits 1*1*n_vocab, attention) of the verified forward, not given yet
+        self.accepted = 0
+        self.proposed = 0
+
+    def logits(self, tokens, audio_features, draft_features, max_tokens):
+        """The logits of the main model for the last token of tokens, 1*1*n_vocab.
+        The previous tokens are in kv_cache, except the last one. max_tokens: no logits are needed for
+        sequences of this length."""
+        if self.rows and self.rows[0][0] == tokens[0, -1].item():
+            self.accepted += 1
+        else:
+            self.rows = []
+            self.verify(tokens, audio_features, draft_features, max_tokens)
+        _, logits, attn = self.rows.pop(0)
+        self.align_attn.set_pending(attn)
+        return logits
+
+    def verify(self, tokens, audio_features, draft_features, max_tokens):
+        # the draft tokens can be at most as many as the rows needed until max_tokens
+        n_draft = min(self.n_draft, max_tokens - tokens.shape[1] - 1)
+        draft = self.propose(tokens, draft_features, n_draft) if n_draft > 0 else []
+        self.proposed += len(draft)
+
+        # the tokens after the last one are not in kv_cache, the last forward could run over more tokens
+        self.kv_cache.length = tokens.shape[1] - 1
+        x = torch.tensor([tokens[0, -1].item()] + draft, dtype=tokens.dtype, device=tokens.device).unsqueeze(0)
+        logits, cross_qk = self.model.decoder.forward_with_attention(x, audio_features, self.kv_cache,
+                                                                     self.align_attn.align_source)
+        for layer_rank, qk in cross_qk.items():
+            self.align_attn.add(layer_rank, qk)
+        attn = self.align_attn.split_pending()
+        self.rows = [(t, logits[:, i:i + 1, :], attn[i]) for i, t in enumerate(x[0].tolist())]
+
+    def propose(self, tokens, draft_features, n_draft):
+        '''Returns up to n_draft greedy tokens of the draft model after tokens, a list of ints'''
+        tokens = tokens[0].tolist()
+        # the cached tokens are reused as far as they agree with tokens
+        keep = 0
+        for a, b in zip(self.draft_tokens, tokens):
+            if a != b:
+                break
+            keep += 1
+        keep = min(keep, len(tokens) - 1)
+        self.draft_kv_cache.length = keep
+        self.draft_tokens = tokens[:keep]
+
+        x = torch.tensor(tokens[keep:], device=draft_features.device).unsqueeze(0)
+        draft = []
+        while True:
+            logits = self.draft_model.decoder(x, draft_features, kv_cache=self.draft_kv_cache)[:, -1, :]
+            self.draft_tokens += x[0].tolist()
+            self.suppress_tokens(logits)
+            t = logits.argmax(dim=-1)
+            draft.append(t.item())
+            if len(draft) == n_draft or draft[-1] == self.eot:
+                break
+            x = t.unsqueeze(0)
+        return draft
@@ -155,3 +155,155 @@ def log_mel_spectrogram(
     log_spec = torch.maximum(log_spec, log_spec.max() - 8.0)
     log_spec = (log_spec + 4.0) / 4.0
     return log_spec
+
+
+class AudioBuffer:
+    """
+    Preallocated buffer of float32 samples that grows at the end and shrinks at the beginning.
+
+    Removing samples from the beginning only moves the start index. When a new chunk does not fit
+    at the end, the samples are moved to the start of the storage, which is doubled if needed.
+    """
+
+    def __init__(self, capacity: int = N_SAMPLES, device: Optional[Union[str, torch.device]] = None):
+        self.data = torch.empty(capacity, dtype=torch.float32, device=device)
+        self.beg = 0
+        self.end = 0
+
+    def __len__(self) -> int:
+        return self.end - self.beg
+
+    def view(self) -> torch.Tensor:
+        """The samples in the buffer, without copying. It is valid until the next `append`."""
+        return self.data[self.beg : self.end]
+
+    def append(self, audio: Union[np.ndarray, torch.Tensor]):
+        if not torch.is_tensor(audio):
+            audio = torch.from_numpy(audio)
+        n = audio.shape[0]
+        if self.end + n > self.data.shape[0]:
+            samples = self.view().clone()
+            if len(samples) + n > self.data.shape[0]:
+                self.data = torch.empty(max(2 * self.data.shape[0], len(samples) + n), dtype=torch.float32, device=self.data.device)
+            self.data[: len(samples)] = samples
+            self.beg, self.end = 0, len(samples)
+        self.data[self.end : self.end + n] = audio
+        self.end += n
+
+    def drop(self, n_samples: int):
+        """Removes `n_samples` samples from the beginning"""
+        self.beg += min(max(n_samples, 0), len(self))
+
+    def reset(self):
+        self.beg = 0
+        self.end = 0
+
+
+class IncrementalLogMel:
+    """
+    Streaming counterpart of `log_mel_spectrogram` for an audio buffer that grows at the end and
+    shrinks at the beginning.
+
+    The STFT frames whose window lies completely inside the audio received so far are computed only
+    once and kept. Every call of `log_mel` computes only the few frames at the seam between the audio
+    and the zero padding, and fills the frames of pure padding with the constant value of silence.
+    The output is the same as `log_mel_spectrogram(audio, n_mels, padding, device)`.
+    """
+
+    def __init__(self, n_mels: int = 80, device: Optional[Union[str, torch.device]] = None, capacity: int = N_SAMPLES):
+        self.n_mels = n_mels
+        self.device = device
+        self.window = torch.hann_window(N_FFT).to(device)
+        self.filters = mel_filters(device, n_mels)
+        # log10 of the clamped mel energy of a frame that contains only zeros
+        self.silence = torch.clamp(torch.zeros(1, device=device), min=1e-10).log10()
+        # the audio samples, preallocated for `capacity` samples
+        self.buffer = AudioBuffer(capacity, device=device)
+        self.reset()
+
+    @property
+    def audio(self) -> torch.Tensor:
+        """The buffered audio samples, a view that is valid until the next `append`"""
+        return self.buffer.view()
+
+    def reset(self):
+        self.buffer.reset()
+        self.frames = torch.zeros(self.n_mels, 0, device=self.device)
+
+    @staticmethod
+    def stable_frames(n_samples: int) -> int:
+        """The number of STFT frames whose window does not reach beyond `n_samples`"""
+        if n_samples <= N_FFT // 2:
+            return 0
+        return (n_samples - N_FFT // 2) // HOP_LENGTH + 1
+
+    def _log_mel_frames(self, audio: torch.Tensor, beg_frame: int, end_frame: int) -> torch.Tensor:
+        """log10 of the mel energies of frames [beg_frame, end_frame) of `torch.stft(audio, center=True)`"""
+        beg = beg_frame * HOP_LENGTH - N_FFT // 2
+        end = (end_frame - 1) * HOP_LENGTH + N_FFT // 2
+        if beg < 0:
+            # the same reflect padding as in torch.stft with center=True
+            audio = torch.cat([audio[1 : N_FFT // 2 + 1].flip(0), audio])
+            beg += N_FFT // 2
+            end += N_FFT // 2
+        stft = torch.stft(audio[beg:end], N_FFT, HOP_LENGTH, window=self.window, center=False, return_complex=True)
+        magnitudes = stft.abs() ** 2
+        mel_spec = self.filters @ magnitudes
+        return torch.clamp(mel_spec, min=1e-10).log10()
+
+    def _update_frames(self):
+        n_stable = self.stable_frames(self.audio.shape[0])
+        if n_stable > self.frames.shape[1]:
+            new_frames = self._log_mel_frames(self.audio, self.frames.shape[1], n_stable)
+            self.frames = torch.cat([self.frames, new_frames], dim=1)
+
+    def append(self, audio: Union[np.ndarray, torch.Tensor]):
+        """Appends new samples to the end of the buffer"""
+        self.buffer.append(audio)
+        self._update_frames()
+
+    def drop(self, n_samples: int):
+        """Removes `n_samples` samples from the beginning of the buffer"""
+        if n_samples <= 0:
+            return
+        self.buffer.drop(n_samples)
+        if n_samples % HOP_LENGTH == 0:
+            # the frame grid is kept, only the first frames depend on the reflect padding at the start
+            n_edge = (N_FFT // 2 + HOP_LENGTH - 1) // HOP_LENGTH
+            frames = self.frames[:, n_samples // HOP_LENGTH :]
+            if frames.shape[1] > n_edge:
+                edge = self._log_mel_frames(self.audio, 0, n_edge)
+                self.frames = torch.cat([edge, frames[:, n_edge:]], dim=1)
+            else:
+                self.frames = frames[:, :0]
+        else:
+            self.frames = self.frames[:, :0]
+        self._update_frames()
+
+    def log_mel(self, padding: int = N_SAMPLES) -> torch.Tensor:
+        """
+        Returns
+        -------
+        torch.Tensor, shape = (n_mels, n_frames)
+            The same as `log_mel_spectrogram` of the buffered audio with `padding` zero samples
+        """
+        assert padding >= N_FFT, "the zero padding must be at least one STFT window long"
+        n_samples = self.audio.shape[0]
+        n_frames = (n_samples + padding) // HOP_LENGTH  # the last STFT frame is dropped
+        # frames whose window reaches into the audio; the following ones see only zeros
+        n_content = (n_samples + N_FFT // 2 - 1) // HOP_LENGTH + 1
+
+        # the frames at the seam between the audio and the padding are computed from the tail only
+        n_stable = self.frames.shape[1]
+        n_edge = (N_FFT // 2 + HOP_LENGTH - 1) // HOP_LENGTH
+        tail_frame = max(0, n_stable - n_edge)
+        tail = self.audio[tail_frame * HOP_LENGTH :]
+        seam_len = (n_content - 1) * HOP_LENGTH + N_FFT // 2 - n_samples
+        tail = F.pad(tail, (0, seam_len))
+        seam = self._log_mel_frames(tail, n_stable - tail_frame, n_content - tail_frame)
+        silence = self.silence.expand(self.n_mels, n_frames - n_content)
+
+        log_spec = torch.cat([self.frames, seam, silence], dim=1)
+        log_spec = torch.maximum(log_spec, log_spec.max() - 8.0)
+        log_spec = (log_spec + 4.0) / 4.0
+        return log_spec
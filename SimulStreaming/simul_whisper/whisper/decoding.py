@@ -133,8 +133,9 @@ class Inference:
         """Perform a forward pass on the decoder and return per-token logits"""
         raise NotImplementedError
 
-    def rearrange_kv_cache(self, source_indices) -> None:
-        """Update the key-value cache according to the updated beams"""
+    def rearrange_kv_cache(self, source_indices: Tensor) -> None:
+        """Update the key-value cache according to the updated beams.
+        source_indices: LongTensor of the source sequence of every new one, on the device of the tokens"""
         raise NotImplementedError
 
     def cleanup_caching(self) -> None:
@@ -171,7 +172,7 @@ class PyTorchInference(Inference):
         self.hooks = []
 
     def rearrange_kv_cache(self, source_indices):
-        if source_indices != list(range(len(source_indices))):
+        if not torch.equal(source_indices, torch.arange(len(source_indices), device=source_indices.device)):
             for module in self.kv_modules:
                 # update the key/value cache to contain the selected sequences
                 self.kv_cache[module] = self.kv_cache[module][source_indices].detach()
@@ -300,6 +301,13 @@ class GreedyDecoder(TokenDecoder):
 
 
 class BeamSearchDecoder(TokenDecoder):
+    """
+    Beam search with the bookkeeping on the device of the logits: the candidates of all beams are
+    ranked by one stable sort, and the finished hypotheses are kept in preallocated tensors. The
+    result is the same as of the loop over the beams and the candidate sequences in the original
+    Whisper code. Only `completed` goes to the host.
+    """
+
     def __init__(
         self,
         beam_size: int,
@@ -312,14 +320,44 @@ class BeamSearchDecoder(TokenDecoder):
         self.inference = inference
         self.patience = patience or 1.0
         self.max_candidates: int = round(beam_size * self.patience)
-        self.finished_sequences = None
 
         assert (
             self.max_candidates > 0
         ), f"Invalid beam size ({beam_size}) or patience ({patience})"
+        self.reset()
 
     def reset(self):
-        self.finished_sequences = None
+        # the finished hypotheses of every audio, allocated in the first update. The extra last slot
+        # is a scratch slot for the candidates that are not saved.
+        self.finished_tokens: Optional[Tensor] = None  # n_audio * (max_candidates + 1) * capacity
+        self.finished_lengths: Optional[Tensor] = None  # n_audio * (max_candidates + 1)
+        self.finished_logprobs: Optional[Tensor] = None  # n_audio * (max_candidates + 1)
+        self.finished_counts: Optional[Tensor] = None  # n_audio
+
+    def _allocate_finished(self, n_audio: int, length: int, device: torch.device):
+        """Makes room for finished sequences of up to `length` tokens, the capacity is doubled when needed"""
+        if self.finished_tokens is None:
+            n_slots = self.max_candidates + 1
+            self.finished_tokens = torch.zeros(n_audio, n_slots, max(length, 64), dtype=torch.long, device=device)
+            self.finished_lengths = torch.zeros(n_audio, n_slots, dtype=torch.long, device=device)
+            self.finished_logprobs = torch.zeros(n_audio, n_slots, device=device)
+            self.finished_counts = torch.zeros(n_audio, dtype=torch.long, device=device)
+        elif self.finished_tokens.shape[2] < length:
+            capacity = max(length, 2 * self.finished_tokens.shape[2])
+            self.finished_tokens = F.pad(self.finished_tokens, (0, capacity - self.finished_tokens.shape[2]))
+
+    @property
+    def finished_sequences(self) -> Optional[List[Dict[Tuple[int, ...], float]]]:
+        """The finished hypotheses of every audio, {sequence: sum of logprobs}, in the order they were found"""
+        if self.finished_tokens is None:
+            return None
+        tokens = self.finished_tokens.tolist()
+        lengths = self.finished_lengths.tolist()
+        logprobs = self.finished_logprobs.tolist()
+        return [
+            {tuple(tokens[i][j][: lengths[i][j]]): logprobs[i][j] for j in range(count)}
+            for i, count in enumerate(self.finished_counts.tolist())
+        ]
 
     def update(
         self, tokens: Tensor, logits: Tensor, sum_logprobs: Tensor
@@ -328,64 +366,68 @@ class BeamSearchDecoder(TokenDecoder):
             raise ValueError(f"{tokens.shape}[0] % {self.beam_size} != 0")
 
         n_audio = tokens.shape[0] // self.beam_size
-        if self.finished_sequences is None:  # for the first update
-            self.finished_sequences = [{} for _ in range(n_audio)]
+        length = tokens.shape[1]
+        n_candidates = self.beam_size + 1  # per beam
+        device = tokens.device
+        self._allocate_finished(n_audio, length + 1, device)
 
+        # STEP 1: calculate the cumulative log probabilities for possible candidates
         logprobs = F.log_softmax(logits.float(), dim=-1)
-        next_tokens, source_indices, finished_sequences = [], [], []
-        for i in range(n_audio):
-            scores, sources, finished = {}, {}, {}
-
-            # STEP 1: calculate the cumulative log probabilities for possible candidates
-            for j in range(self.beam_size):
-                idx = i * self.beam_size + j
-                prefix = tokens[idx].tolist()
-                for logprob, token in zip(*logprobs[idx].topk(self.beam_size + 1)):
-                    new_logprob = (sum_logprobs[idx] + logprob).item()
-                    sequence = tuple(prefix + [token.item()])
-                    scores[sequence] = new_logprob
-                    sources[sequence] = idx
-
-            # STEP 2: rank the candidates and keep the top beam_size sequences for each audio
-            saved = 0
-            for sequence in sorted(scores, key=scores.get, reverse=True):
-                if sequence[-1] == self.eot:
-                    finished[sequence] = scores[sequence]
-                else:
-                    sum_logprobs[len(next_tokens)] = scores[sequence]
-                    next_tokens.append(sequence)
-                    source_indices.append(sources[sequence])
+        top_logprobs, top_tokens = logprobs.topk(n_candidates)
+        scores = (sum_logprobs[:, None] + top_logprobs).view(n_audio, -1)
+        candidate_tokens = top_tokens.view(n_audio, -1)
+
+        # identical beams, e.g. all of them in the first step, give the same candidate sequences.
+        # They are ranked once, at the place of the first beam and with the source of the last one.
+        beams = tokens.view(n_audio, self.beam_size, length)
+        same = (beams[:, :, None, :] == beams[:, None, :, :]).all(dim=-1)
+        order = torch.arange(self.beam_size, device=device)
+        first = torch.where(same, order, self.beam_size).amin(dim=-1)
+        last = torch.where(same, order, -1).amax(dim=-1) + torch.arange(n_audio, device=device)[:, None] * self.beam_size
+        unique = (first == order).repeat_interleave(n_candidates, dim=-1)
+        sources = last.repeat_interleave(n_candidates, dim=-1)
+
+        # STEP 2: rank the candidates and keep the top beam_size sequences for each audio.
+        # The stable sort keeps the order of equal scores, as sorted() of the candidate sequences.
+        ranked = torch.sort(scores.masked_fill(~unique, -np.inf), dim=-1, descending=True, stable=True).indices
+        scores = scores.gather(1, ranked)
+        candidate_tokens = candidate_tokens.gather(1, ranked)
+        sources = sources.gather(1, ranked)
+        unique = unique.gather(1, ranked)
+        is_eot = candidate_tokens == self.eot
+
+        # the candidates are taken until the beam_size-th sequence that continues
+        continuing = unique & ~is_eot
+        taken = continuing.cumsum(dim=-1) - continuing.long() < self.beam_size
+        selected = torch.sort((~continuing).to(torch.uint8), dim=-1, stable=True).indices[:, : self.beam_size]
+        source_indices = sources.gather(1, selected).flatten()
+        sum_logprobs[:] = scores.gather(1, selected).flatten()
+        next_tokens = torch.cat([tokens[source_indices], candidate_tokens.gather(1, selected).view(-1, 1)], dim=-1)
+
+        # add newly finished sequences to self.finished_*, the best first, until the candidate list is
+        # full. The others are written to the scratch slot.
+        finished = unique & is_eot & taken
+        slots = self.finished_counts[:, None] + finished.cumsum(dim=-1) - 1
+        saved = finished & (slots < self.max_candidates)
+        slots = torch.where(saved, slots, self.max_candidates)
+        audio = torch.arange(n_audio, device=device)[:, None].expand_as(slots)
+        self.finished_tokens[audio, slots, :length] = tokens[sources]
+        self.finished_tokens[audio, slots, length] = self.eot
+        self.finished_lengths[audio, slots] = length + 1
+        self.finished_logprobs[audio, slots] = scores
+        self.finished_counts += saved.sum(dim=-1)
 
-                    saved += 1
-                    if saved == self.beam_size:
-                        break
-
-            finished_sequences.append(finished)
-
-        tokens = torch.tensor(next_tokens, device=tokens.device)
         self.inference.rearrange_kv_cache(source_indices)
 
-        # add newly finished sequences to self.finished_sequences
-        assert len(self.finished_sequences) == len(finished_sequences)
-        for previously_finished, newly_finished in zip(
-            self.finished_sequences, finished_sequences
-        ):
-            for seq in sorted(newly_finished, key=newly_finished.get, reverse=True):
-                if len(previously_finished) >= self.max_candidates:
-                    break  # the candidate list is full
-                previously_finished[seq] = newly_finished[seq]
-
         # mark as completed if all audio has enough number of samples
-        completed = all(
-            len(sequences) >= self.max_candidates
-            for sequences in self.finished_sequences
-        )
-        return tokens, completed
+        completed = bool((self.finished_counts >= self.max_candidates).all())
+        return next_tokens, completed
 
     def finalize(self, preceding_tokens: Tensor, sum_logprobs: Tensor):
         # collect all finished sequences, including patience, and add unfinished ones if not enough
+        finished_sequences = self.finished_sequences
         sum_logprobs = sum_logprobs.cpu()
-        for i, sequences in enumerate(self.finished_sequences):
+        for i, sequences in enumerate(finished_sequences):
             if (
                 len(sequences) < self.beam_size
             ):  # when not enough sequences are finished
@@ -397,10 +439,10 @@ class BeamSearchDecoder(TokenDecoder):
 
         tokens: List[List[Tensor]] = [
             [torch.tensor(seq) for seq in sequences.keys()]
-            for sequences in self.finished_sequences
+            for sequences in finished_sequences
         ]
         sum_logprobs: List[List[float]] = [
-            list(sequences.values()) for sequences in self.finished_sequences
+            list(sequences.values()) for sequences in finished_sequences
         ]
         return tokens, sum_logprobs
 
@@ -2,7 +2,7 @@ import base64
 import gzip
 from contextlib import contextmanager
 from dataclasses import dataclass
-from typing import Dict, Iterable, Optional, Tuple
+from typing import Dict, Iterable, List, Optional, Tuple, Union
 
 import numpy as np
 import torch
@@ -68,9 +68,97 @@ def sinusoids(length, channels, max_timescale=10000):
     return torch.cat([torch.sin(scaled_time), torch.cos(scaled_time)], dim=1)
 
 import sys  ## this is mine, for debugging
+class KVCache:
+    """
+    Preallocated key/value cache of the decoder self-attention, for `n_batch` sequences of up to
+    `n_ctx` tokens. The keys and values of new tokens are written in place at the position of
+    the `length` cursor, which is moved by `TextDecoder.forward` after all the layers are done.
+
+    The cross-attention keys and values are kept separately. They are computed once per encoder
+    output, and reused as long as the decoder gets the same encoder output tensor, across decoding
+    steps and across sequences.
+
+    The same object is reused for the next sequence after `reset()`.
+
+    Several decoding loops can keep their sequences in one cache, each in its own `rows()`, with its
+    own length. Their steps of one token then run in one batch, see `TextDecoder.batch_step`.
+    """
+
+    def __init__(self, cache_ids: Iterable[str], n_batch: int, n_ctx: int, n_state: int,
+                 device: Optional[torch.device] = None, dtype: Optional[torch.dtype] = None):
+        self_attn = {
+            cache_id: torch.zeros(n_batch, n_ctx, n_state, device=device, dtype=dtype) for cache_id in cache_ids
+        }
+        self._init(self_attn, torch.arange(n_batch, device=device), parent=None)
+
+    def _init(self, self_attn: Dict[str, Tensor], row_index: Tensor, parent: Optional["KVCache"]):
+        cache = next(iter(self_attn.values()))
+        n_batch, self.n_ctx, n_state = cache.shape
+        self.self_attn = self_attn
+        self.cross_attn: Dict[str, Tensor] = {}
+        self.cross_attn_source: Optional[Tensor] = None
+        self.length = 0
+        # the cache that the rows are taken from and their indices in it, see rows()
+        self.parent = parent
+        self.row_index = row_index
+        # for reorder(): the identity permutation, and the space for one reordered cache
+        self.batch_index = torch.arange(n_batch, device=cache.device)
+        self.scratch = torch.empty(n_batch * self.n_ctx * n_state, device=cache.device, dtype=cache.dtype)
+
+    def rows(self, beg: int, n_batch: int) -> "KVCache":
+        """
+        A `KVCache` of `n_batch` sequences, whose self-attention caches are the rows `beg` ... `beg + n_batch - 1`
+        of this one, not copies. It has its own length and cross-attention keys and values.
+        """
+        self_attn = {cache_id: cache[beg : beg + n_batch] for cache_id, cache in self.self_attn.items()}
+        rows = KVCache.__new__(KVCache)
+        rows._init(self_attn, self.row_index[beg : beg + n_batch], parent=self)
+        return rows
+
+    def reset(self):
+        """Starts a new sequence. The cross-attention keys and values stay valid for the same encoder output."""
+        self.length = 0
+
+    def cross_attention_kv(self, attn: "MultiHeadAttention", xa: Tensor) -> Tuple[Tensor, Tensor]:
+        """The cross-attention keys and values of `attn` for the encoder output `xa`"""
+        if xa is not self.cross_attn_source:
+            self.cross_attn = {}
+            self.cross_attn_source = xa
+        if attn.key.cache_id not in self.cross_attn:
+            self.cross_attn[attn.key.cache_id] = attn.key(xa)
+            self.cross_attn[attn.value.cache_id] = attn.value(xa)
+        return self.cross_attn[attn.key.cache_id], self.cross_attn[attn.value.cache_id]
+
+    def update(self, cache_id: str, x: Tensor) -> Tensor:
+        """Writes keys or values `x` of the new tokens at the cursor, returns them for all the tokens"""
+        end = self.length + x.shape[1]
+        if end > self.n_ctx:
+            raise ValueError(f"KV cache overflow: {end} > {self.n_ctx} tokens")
+        cache = self.self_attn[cache_id]
+        cache[: x.shape[0], self.length : end] = x
+        return cache[: x.shape[0], :end]
+
+    def advance(self, n_tokens: int):
+        self.length += n_tokens
+
+    def reorder(self, source_indices: Tensor):
+        """Rearranges the cached sequences according to the updated beams, in place and without allocation.
+        source_indices: LongTensor on the device of the cache, nothing is done if it's the identity."""
+        n_batch = source_indices.shape[0]
+        if torch.equal(source_indices, self.batch_index[:n_batch]):
+            return
+        for cache in self.self_attn.values():
+            cached = cache[:n_batch, : self.length]
+            reordered = self.scratch[: cached.numel()].view(cached.shape)
+            torch.index_select(cached, 0, source_indices, out=reordered)
+            cached.copy_(reordered)
+
+
 class MultiHeadAttention(nn.Module):
 
-    use_sdpa = False  # disabling: https://github.com/linto-ai/whisper-timestamped/issues/212
+    # disabling: https://github.com/linto-ai/whisper-timestamped/issues/212
+    # The fused attention doesn't return qk. It can be enabled per module, see Whisper.set_attention_backend.
+    use_sdpa = False
 
     def __init__(self, n_state: int, n_head: int, cache_id: str):
         super().__init__()
@@ -88,14 +176,22 @@ class MultiHeadAttention(nn.Module):
         x: Tensor,
         xa: Optional[Tensor] = None,
         mask: Optional[Tensor] = None,
-        kv_cache: Optional[dict] = None,
+        kv_cache: Optional[Union[dict, KVCache]] = None,
+        need_qk: bool = False,
     ):
+        """Returns the output and the attention logits qk. qk is None with the fused attention, unless need_qk."""
         #print("MultiHeadAttention forward",file=sys.stderr)
         q = self.query(x)
 #        print(q.shape, x is None, mask is None, list(kv_cache.keys()) if kv_cache is not None else None, file=sys.stderr)
         # print(mask, kv_cache, xa, file=sys.stderr)
 
-        if kv_cache is None or xa is None or self.key.cache_id not in kv_cache:
+        if isinstance(kv_cache, KVCache):
+            if xa is None:
+                k = kv_cache.update(self.key.cache_id, self.key(x))
+                v = kv_cache.update(self.value.cache_id, self.value(x))
+            else:
+                k, v = kv_cache.cross_attention_kv(self, xa)
+        elif kv_cache is None or xa is None or self.key.cache_id not in kv_cache:
             k = self.key(x if xa is None else xa)
             v = self.value(x if xa is None else xa)
             # print(self.key.cache_id, "cache miss") # , kv_cache is None, xa is None, self.key.cache_id not in kv_cache if kv_cache is not None else None, k.shape, x.shape)
@@ -108,9 +204,35 @@ class MultiHeadAttention(nn.Module):
             k = kv_cache[self.key.cache_id]
             v = kv_cache[self.value.cache_id]
         # print(self.key.cache_id, "qkv attention", q.shape, k.shape, v.shape)
-        wv, qk = self.qkv_attention(q, k, v, mask)
+        if mask is not None:
+            # the queries are the last n_ctx of the n_kv positions, the previous ones are in the kv cache.
+            # A single query attends to all of them.
+            n_ctx, n_kv = x.shape[1], k.shape[1]
+            mask = mask[n_kv - n_ctx : n_kv, :n_kv] if n_ctx > 1 else None
+        wv, qk = self.qkv_attention(q, k, v, mask, need_qk)
         return self.out(wv), qk
 
+    def step(self, x: Tensor, k_cache: Tensor, v_cache: Tensor, position: Tensor, mask: Tensor):
+        """Self-attention of one new token per sequence, with fixed shapes for TextDecoder.step.
+        The keys and values of x are written to the preallocated caches (n_batch, n_ctx, n_state) at
+        position, and the query attends to the whole caches, mask hides the positions after it."""
+        q = self.query(x)
+        k_cache.index_copy_(1, position, self.key(x))
+        v_cache.index_copy_(1, position, self.value(x))
+        wv, _ = self.qkv_attention(q, k_cache, v_cache, mask)
+        return self.out(wv)
+
+    def batch_step(self, x: Tensor, k_cache: Tensor, v_cache: Tensor, rows: Tensor, positions: Tensor, mask: Tensor):
+        """Self-attention of one new token per sequence, for TextDecoder.batch_step. The sequences are
+        the rows of the caches (n_rows, n_ctx, n_state), each at its own position. The keys and values
+        of x are written there, and mask (batch_size, 1, 1, n_kv) hides the positions after it."""
+        q = self.query(x)
+        k_cache[rows, positions] = self.key(x)[:, 0]
+        v_cache[rows, positions] = self.value(x)[:, 0]
+        n_kv = mask.shape[-1]
+        wv, _ = self.qkv_attention(q, k_cache[rows, :n_kv], v_cache[rows, :n_kv], mask)
+        return self.out(wv)
+
     # def qkv_attention(
     #     self, q: Tensor, k: Tensor, v: Tensor, mask: Optional[Tensor] = None
     # ):
@@ -130,7 +252,7 @@ class MultiHeadAttention(nn.Module):
 
 
     def qkv_attention(
-        self, q: Tensor, k: Tensor, v: Tensor, mask: Optional[Tensor] = None
+        self, q: Tensor, k: Tensor, v: Tensor, mask: Optional[Tensor] = None, need_qk: bool = False
     ) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
         n_batch, n_ctx, n_state = q.shape
         scale = (n_state // self.n_head) ** -0.25
@@ -138,16 +260,18 @@ class MultiHeadAttention(nn.Module):
         k = k.view(*k.shape[:2], self.n_head, -1).permute(0, 2, 1, 3)
         v = v.view(*v.shape[:2], self.n_head, -1).permute(0, 2, 1, 3)
 
-        if SDPA_AVAILABLE and MultiHeadAttention.use_sdpa:
-            a = scaled_dot_product_attention(
-                q, k, v, is_causal=mask is not None and n_ctx > 1
-            )
+        # mask: additive, of the shape (n_ctx, n_kv), or None
+        if SDPA_AVAILABLE and self.use_sdpa and not need_qk:
+            if mask is not None and n_ctx == k.shape[2]:
+                a = scaled_dot_product_attention(q, k, v, is_causal=True)
+            else:
+                a = scaled_dot_product_attention(q, k, v, attn_mask=None if mask is None else mask.to(q.dtype))
             out = a.permute(0, 2, 1, 3).flatten(start_dim=2)
             qk = None
         else:
             qk = (q * scale) @ (k * scale).transpose(-1, -2)
             if mask is not None:
-                qk = qk + mask[:n_ctx, :n_ctx]
+                qk = qk + mask
             qk = qk.float()
 
             w = F.softmax(qk, dim=-1).to(q.dtype)
@@ -179,16 +303,65 @@ class ResidualAttentionBlock(nn.Module):
         x: Tensor,
         xa: Optional[Tensor] = None,
         mask: Optional[Tensor] = None,
-        kv_cache: Optional[dict] = None,
+        kv_cache: Optional[Union[dict, KVCache]] = None,
+        need_cross_qk: bool = False,
     ):
+        """Returns the output, or the output and the cross-attention logits qk if need_cross_qk."""
         # print("ResidualAttentionBlock forward",file=sys.stderr)
         # print(x.shape, file=sys.stderr)
         x = x + self.attn(self.attn_ln(x), mask=mask, kv_cache=kv_cache)[0]
+        cross_qk = None
         if self.cross_attn:
-            x = x + self.cross_attn(self.cross_attn_ln(x), xa, kv_cache=kv_cache)[0]
+            out, cross_qk = self.cross_attn(self.cross_attn_ln(x), xa, kv_cache=kv_cache, need_qk=need_cross_qk)
+            x = x + out
         x = x + self.mlp(self.mlp_ln(x))
+        if need_cross_qk:
+            return x, cross_qk
         return x
 
+    def step(
+        self,
+        x: Tensor,
+        self_kv: Tuple[Tensor, Tensor],
+        cross_kv: Tuple[Tensor, Tensor],
+        position: Tensor,
+        mask: Tensor,
+        need_cross_qk: bool = False,
+    ):
+        """One token of a decoder block with fixed shapes, see TextDecoder.step.
+        Returns the output and the cross-attention logits qk, or None."""
+        x = x + self.attn.step(self.attn_ln(x), *self_kv, position, mask)
+        out, cross_qk = self.cross_attn.qkv_attention(self.cross_attn.query(self.cross_attn_ln(x)), *cross_kv,
+                                                      need_qk=need_cross_qk)
+        x = x + self.cross_attn.out(out)
+        x = x + self.mlp(self.mlp_ln(x))
+        return x, cross_qk
+
+    def batch_step(
+        self,
+        x: Tensor,
+        self_kv: Tuple[Tensor, Tensor],
+        cross_kv: List[Tuple[Tensor, Tensor]],
+        groups: List[int],
+        rows: Tensor,
+        positions: Tensor,
+        mask: Tensor,
+        need_cross_qk: bool = False,
+    ):
+        """One token of a decoder block for the sequences at different positions, see TextDecoder.batch_step.
+        Returns the output and the list of the cross-attention logits qk of the groups, or None."""
+        x = x + self.attn.batch_step(self.attn_ln(x), *self_kv, rows, positions, mask)
+        # every group attends to its own encoder output
+        q = self.cross_attn.query(self.cross_attn_ln(x))
+        out, cross_qk = [], []
+        for q_group, kv in zip(q.split(groups), cross_kv):
+            out_group, qk = self.cross_attn.qkv_attention(q_group, *kv, need_qk=need_cross_qk)
+            out.append(out_group)
+            cross_qk.append(qk)
+        x = x + self.cross_attn.out(torch.cat(out))
+        x = x + self.mlp(self.mlp_ln(x))
+        return x, cross_qk if need_cross_qk else None
+
 
 class AudioEncoder(nn.Module):
     def __init__(
@@ -255,31 +428,135 @@ class TextDecoder(nn.Module):
         mask = torch.empty(n_ctx, n_ctx).fill_(-np.inf).triu_(1)
         self.register_buffer("mask", mask, persistent=False)
 
-    def forward(self, x: Tensor, xa: Tensor, kv_cache: Optional[dict] = None):
+    def forward(self, x: Tensor, xa: Tensor, kv_cache: Optional[Union[dict, KVCache]] = None):
         """
         x : torch.LongTensor, shape = (batch_size, <= n_ctx)
             the text tokens
         xa : torch.Tensor, shape = (batch_size, n_audio_ctx, n_audio_state)
             the encoded audio features to be attended on
+        kv_cache : dict or KVCache
+            the keys and values of the previous tokens
         """
+        return self.forward_with_attention(x, xa, kv_cache)[0]
 
-        offset = next(iter(kv_cache.values())).shape[1] if kv_cache else 0
+    def forward_with_attention(
+        self, x: Tensor, xa: Tensor, kv_cache: Optional[Union[dict, KVCache]] = None, qk_layers: Iterable[int] = ()
+    ) -> Tuple[Tensor, Dict[int, Tensor]]:
+        """
+        The same as `forward`, and it also returns the cross-attention logits of the layers in
+        `qk_layers`: {layer: (batch_size, n_head, n_tokens, n_audio_ctx)}, without forward hooks.
+        The decoder keeps no state between the calls, the previous tokens are only in `kv_cache`,
+        so one model can be used by several decoding loops, each with its own `KVCache`.
+        """
+
+        if isinstance(kv_cache, KVCache):
+            offset = kv_cache.length
+        else:
+            offset = next(iter(kv_cache.values())).shape[1] if kv_cache else 0
         x = (
             self.token_embedding(x)
             + self.positional_embedding[offset : offset + x.shape[-1]]
         )
         # x = x.to(xa.dtype)
 
-        i = 0
-        for block in self.blocks:
+        qk_layers = set(qk_layers)
+        cross_qk = {}
+        for i, block in enumerate(self.blocks):
             # print(f"decoder layer {i}")
-            x = block(x, xa, mask=self.mask, kv_cache=kv_cache)
-            i += 1
+            if i in qk_layers:
+                x, cross_qk[i] = block(x, xa, mask=self.mask, kv_cache=kv_cache, need_cross_qk=True)
+            else:
+                x = block(x, xa, mask=self.mask, kv_cache=kv_cache)
+        if isinstance(kv_cache, KVCache):
+            kv_cache.advance(x.shape[1])
 
         x = self.ln(x)
         logits = x @ torch.transpose(self.token_embedding.weight, 0, 1)
 
-        return logits
+        return logits, cross_qk
+
+    def step(
+        self,
+        x: Tensor,
+        position: Tensor,
+        self_kv: List[Tuple[Tensor, Tensor]],
+        cross_kv: List[Tuple[Tensor, Tensor]],
+        qk_layers: Tuple[int, ...] = (),
+    ) -> Tuple[Tensor, Dict[int, Tensor]]:
+        """
+        One decoding step with shapes that don't depend on the position, for torch.compile, see
+        simul_whisper/compiled.py. Otherwise the same as `forward_with_attention` of one token.
+
+        x : torch.LongTensor, shape = (batch_size, 1)
+            the last token of every sequence
+        position : torch.LongTensor, shape = (1,)
+            the position of the token. Its keys and values are written at it in the self-attention caches.
+        self_kv : [(keys, values)] per layer, shape = (batch_size, n_ctx, n_state)
+            the preallocated self-attention caches, e.g. of KVCache, filled up to position
+        cross_kv : [(keys, values)] per layer, shape = (batch_size, n_audio_ctx, n_state)
+            the cross-attention keys and values of the encoder output
+        """
+        x = self.token_embedding(x) + self.positional_embedding[position]
+        mask = self.mask[position]
+
+        cross_qk = {}
+        for i, block in enumerate(self.blocks):
+            x, qk = block.step(x, self_kv[i], cross_kv[i], position, mask, need_cross_qk=i in qk_layers)
+            if i in qk_layers:
+                cross_qk[i] = qk
+
+        x = self.ln(x)
+        logits = x @ torch.transpose(self.token_embedding.weight, 0, 1)
+
+        return logits, cross_qk
+
+    def batch_step(
+        self,
+        x: Tensor,
+        rows: Tensor,
+        positions: Tensor,
+        self_kv: List[Tuple[Tensor, Tensor]],
+        cross_kv: List[List[Tuple[Tensor, Tensor]]],
+        groups: List[int],
+        qk_layers: Iterable[int] = (),
+    ) -> Tuple[Tensor, Dict[int, List[Tensor]]]:
+        """
+        One decoding step of sequences at different positions and with different encoder outputs, e.g. of
+        several sessions that keep their sequences in the rows of one `KVCache`, see `KVCache.rows`. For
+        every sequence, it's the same as `forward_with_attention` of one token with its own cache.
+
+        x : torch.LongTensor, shape = (batch_size, 1)
+            the last token of every sequence
+        rows : torch.LongTensor, shape = (batch_size,)
+            the row of every sequence in the self-attention caches
+        positions : torch.LongTensor, shape = (batch_size,)
+            the position of every token, i.e. the length of its sequence in the cache. Its keys and values
+            are written at it, and a causal mask per row hides the positions after it.
+        self_kv : [(keys, values)] per layer, shape = (n_rows, n_ctx, n_state)
+            the self-attention caches of all the rows
+        cross_kv : [[(keys, values)] per group] per layer, shape = (1, n_audio_ctx, n_state)
+            the cross-attention keys and values of the encoder output of every group
+        groups : the numbers of the consecutive sequences with the same encoder output, e.g. the beams of a session
+
+        Returns the logits (batch_size, 1, n_vocab) and the cross-attention logits of `qk_layers`,
+        {layer: [(group size, n_head, 1, n_audio_ctx) per group]}.
+        """
+        x = self.token_embedding(x) + self.positional_embedding[positions].unsqueeze(1)
+        n_kv = int(positions.max()) + 1
+        mask = self.mask[positions, :n_kv][:, None, None, :]
+
+        qk_layers = set(qk_layers)
+        cross_qk = {}
+        for i, block in enumerate(self.blocks):
+            x, qk = block.batch_step(x, self_kv[i], cross_kv[i], groups, rows, positions, mask,
+                                     need_cross_qk=i in qk_layers)
+            if i in qk_layers:
+                cross_qk[i] = qk
+
+        x = self.ln(x)
+        logits = x @ torch.transpose(self.token_embedding.weight, 0, 1)
+
+        return logits, cross_qk
 
 
 class Whisper(nn.Module):
@@ -343,6 +620,49 @@ class Whisper(nn.Module):
     def num_languages(self):
         return self.dims.n_vocab - 51765 - int(self.is_multilingual)
 
+    def new_kv_cache(self, n_batch: int) -> KVCache:
+        """
+        Returns a preallocated `KVCache` for the decoder, for `n_batch` sequences of up to `n_text_ctx`
+        tokens. Unlike `install_kv_cache_hooks`, it needs no hooks: the attention modules write into it.
+        """
+        cache_ids = []
+        for block in self.decoder.blocks:
+            cache_ids += [block.attn.key.cache_id, block.attn.value.cache_id]
+        weight = self.decoder.token_embedding.weight
+        return KVCache(cache_ids, n_batch, self.dims.n_text_ctx, self.dims.n_text_state,
+                       device=weight.device, dtype=weight.dtype)
+
+    def set_attention_backend(self, qk_layers: Iterable[int] = (), use_sdpa: bool = True):
+        """
+        Selects the fused `scaled_dot_product_attention` for the attention modules whose attention
+        weights are not needed: the encoder, the decoder self-attention and the cross-attention of the
+        decoder layers that are not in `qk_layers`. The cross-attention of `qk_layers` keeps the explicit
+        computation that returns qk, e.g. to forward hooks. `TextDecoder.forward_with_attention` needs
+        no such layers, it computes qk where it's requested. With use_sdpa=False, all modules compute qk.
+        """
+        qk_layers = set(qk_layers)
+        for block in self.encoder.blocks:
+            block.attn.use_sdpa = use_sdpa
+        for i, block in enumerate(self.decoder.blocks):
+            block.attn.use_sdpa = use_sdpa
+            block.cross_attn.use_sdpa = use_sdpa and i not in qk_layers
+
+    def quantize_dynamic(self, dtype: torch.dtype = torch.qint8) -> "Whisper":
+        """
+        Replaces the `nn.Linear` layers of the encoder and decoder, in place, by dynamically quantized
+        ones: int8 weights, and activations quantized on the fly. It is for inference on CPU, the model
+        must be on CPU. The `cache_id` of the key and value projections is kept, and the forward hooks
+        of the attention modules keep working, because only their child modules are replaced.
+        """
+        from torch.ao.quantization import quantize_dynamic
+
+        cache_ids = {name: module.cache_id for name, module in self.named_modules() if hasattr(module, "cache_id")}
+        quantize_dynamic(self, {nn.Linear}, dtype=dtype, inplace=True)
+        modules = dict(self.named_modules())
+        for name, cache_id in cache_ids.items():
+            modules[name].cache_id = cache_id
+        return self
+
     # 为decoder加入缓存机制，每次推理时保存上次的k和v，下次推理无需重新计算
     def install_kv_cache_hooks(self, cache: Optional[dict] = None):
         """
@@ -284,17 +284,24 @@ class Tokenizer:
         return self.split_tokens_on_spaces(tokens)
 
     def split_tokens_on_unicode(self, tokens: List[int]):
+        """
+        Splits the tokens into the shortest groups that are decoded as complete unicode characters.
+        The bytes of every token are decoded once, so it takes linear time in the number of tokens.
+        """
         decoded_full = self.decode_with_timestamps(tokens)
         replacement_char = "\ufffd"
 
         words = []
         word_tokens = []
         current_tokens = []
+        current_bytes = b""
         unicode_offset = 0
 
         for token in tokens:
             current_tokens.append(token)
-            decoded = self.decode_with_timestamps(current_tokens)
+            current_bytes += token_bytes(self.encoding, token)
+            # the same as decode_with_timestamps(current_tokens), only the last group is decoded
+            decoded = current_bytes.decode("utf-8", errors="replace")
 
             if (
                 replacement_char not in decoded
@@ -304,6 +311,7 @@ class Tokenizer:
                 words.append(decoded)
                 word_tokens.append(current_tokens)
                 current_tokens = []
+                current_bytes = b""
                 unicode_offset += len(decoded)
 
         return words, word_tokens
@@ -315,7 +323,7 @@ class Tokenizer:
 
         for subword, subword_tokens in zip(subwords, subword_tokens_list):
             special = subword_tokens[0] >= self.eot
-            with_space = subword.startswith(" ")
+            with_space = token_bytes(self.encoding, subword_tokens[0]).startswith(b" ")
             punctuation = subword.strip() in string.punctuation
             if special or with_space or punctuation or len(words) == 0:
                 words.append(subword)
@@ -327,6 +335,12 @@ class Tokenizer:
         return words, word_tokens
 
 
+@lru_cache(maxsize=65536)
+def token_bytes(encoding: tiktoken.Encoding, token: int) -> bytes:
+    """The bytes of a token, including the special and timestamp tokens"""
+    return encoding.decode_single_token_bytes(token)
+
+
 @lru_cache(maxsize=None)
 def get_encoding(name: str = "gpt2", num_languages: int = 99):
     vocab_path = os.path.join(os.path.dirname(__file__), "assets", f"{name}.tiktoken")
@@ -3,10 +3,12 @@ import argparse
 
 import sys
 import logging
+from collections import deque
 import torch
 
 from simul_whisper.config import AlignAttConfig
 from simul_whisper.simul_whisper import PaddedAlignAttWhisper
+from simul_whisper.batching import EncoderBatcher, DecoderBatcher
 
 logger = logging.getLogger(__name__)
 
@@ -17,6 +19,26 @@ def simulwhisper_args(parser):
     group.add_argument("--beams","-b", type=int, default=1, help="Number of beams for beam search decoding. If 1, GreedyDecoder is used.")
     group.add_argument("--decoder",type=str, default=None, help="Override automatic selection of beam or greedy decoder. "
                         "If beams > 1 and greedy: invalid.")
+    group.add_argument('--draft_model_path', type=str, default=None,
+                        help='The file path to a smaller Whisper .pt model with the same vocabulary, e.g. base.pt for small.pt. It proposes '
+                        'the tokens and the main model verifies them in one decoder forward, which is faster if most proposed tokens are right. '
+                        'The output of the greedy decoder stays the same. Not for beam search.')
+    group.add_argument('--draft_tokens', type=int, default=4, help='The number of tokens proposed by the draft model at once.')
+    group.add_argument('--int8', action="store_true", default=False,
+                        help='Dynamic int8 quantization of the linear layers of the encoder and decoder, for inference on CPU. '
+                        'The model runs on CPU even if a GPU is available. It is faster and it needs less memory, with a small loss of accuracy. '
+                        'See benchmarks/quantization.py.')
+    group.add_argument('--sdpa', action=argparse.BooleanOptionalAction, default=True,
+                        help='Use the fused scaled_dot_product_attention in the encoder, in the decoder self-attention, and in the cross-attention '
+                        'of the decoder layers without alignment heads. Only the cross-attention with alignment heads computes the attention '
+                        'weights for AlignAtt. --no-sdpa computes them everywhere, as the original Whisper code.')
+    group.add_argument('--compile', action="store_true", default=False,
+                        help='torch.compile the encoder and the single-token decoder step. The compilation runs in the warmup, for all '
+                        'the encoder input lengths, so use it with a warmup file, and preferably with --encoder_bucket of at least few seconds. '
+                        'See benchmarks/compiled.py.')
+    group.add_argument('--compile_cache_dir', type=str, default=None,
+                        help='Directory where the compiled kernels are cached, so that the next start with --compile is faster. '
+                        'Default: the directory of torch inductor, e.g. /tmp/torchinductor_$USER.')
 
     group = parser.add_argument_group('Audio buffer')
     group.add_argument('--audio_max_len', type=float, default=30.0, 
@@ -25,6 +47,10 @@ def simulwhisper_args(parser):
                         help='Skip processing if the audio buffer is shorter than this length, in seconds. Useful when the --min-chunk-size is small.')
 
 
+    group.add_argument('--encoder_bucket', type=float, default=None,
+                        help='If set, the encoder processes only the audio in the buffer rounded up to a multiple of this length in seconds, '
+                        'instead of the audio padded to 30 seconds. It is faster for short buffers, especially on CPU, but it may decrease quality.')
+
     group = parser.add_argument_group('AlignAtt argument')
     group.add_argument('--frame_threshold', type=int, default=25, 
                         help='Threshold for the attention-guided decoding. The AlignAtt policy will decode only ' \
@@ -67,7 +93,8 @@ def simul_asr_factory(args):
         # else: it is greedy or beam, that's ok 
     
     a = { v:getattr(args, v) for v in ["model_path", "cif_ckpt_path", "frame_threshold", "audio_min_len", "audio_max_len", "beams", "task",
-                                       "never_fire", 'init_prompt', 'static_init_prompt', 'max_context_tokens', "logdir"
+                                       "never_fire", 'init_prompt', 'static_init_prompt', 'max_context_tokens', "logdir", "encoder_bucket",
+                                       "draft_model_path", "draft_tokens", "int8", "sdpa", "compile", "compile_cache_dir"
                                        ]}
     a["language"] = args.lan
     a["segment_length"] = args.min_chunk_size
@@ -77,6 +104,14 @@ def simul_asr_factory(args):
         raise ValueError("min_chunk_size must be smaller than audio_max_len")
     if args.audio_min_len > args.audio_max_len:
         raise ValueError("audio_min_len must be smaller than audio_max_len")
+    if args.encoder_bucket is not None and args.encoder_bucket <= 0:
+        raise ValueError("encoder_bucket must be positive")
+    if args.draft_model_path is not None and decoder != "greedy":
+        raise ValueError("draft_model_path can be used only with the greedy decoder")
+    if args.draft_tokens < 1:
+        raise ValueError("draft_tokens must be at least 1")
+    if args.compile and args.int8:
+        raise ValueError("The int8 quantized model can't be compiled, use either --compile or --int8")
     logger.info(f"Arguments: {a}")
     asr = SimulWhisperASR(**a)
     return asr, SimulWhisperOnline(asr)
@@ -86,7 +121,8 @@ class SimulWhisperASR(ASRBase):
     sep = " "
 
     def __init__(self, language, model_path, cif_ckpt_path, frame_threshold, audio_max_len, audio_min_len, segment_length, beams, task, 
-                 decoder_type, never_fire, init_prompt, static_init_prompt, max_context_tokens, logdir):
+                 decoder_type, never_fire, init_prompt, static_init_prompt, max_context_tokens, logdir, encoder_bucket=None,
+                 draft_model_path=None, draft_tokens=4, int8=False, sdpa=True, compile=False, compile_cache_dir=None):
         cfg = AlignAttConfig(
             model_path=model_path, 
             segment_length=segment_length,
@@ -94,6 +130,7 @@ class SimulWhisperASR(ASRBase):
             language=language,
             audio_max_len=audio_max_len, 
             audio_min_len=audio_min_len,
+            encoder_bucket=encoder_bucket,
             cif_ckpt_path=cif_ckpt_path,
             decoder_type=decoder_type, #"greedy" if beams==1 else "beam",
             beam_size=beams,
@@ -103,9 +140,17 @@ class SimulWhisperASR(ASRBase):
             max_context_tokens=max_context_tokens,
             static_init_prompt=static_init_prompt,
             logdir=logdir,
+            draft_model_path=draft_model_path,
+            draft_tokens=draft_tokens,
+            int8=int8,
+            sdpa=sdpa,
+            compile=compile,
+            compile_cache_dir=compile_cache_dir,
         )
         logger.info(f"Language: {language}")
         self.model = PaddedAlignAttWhisper(cfg)
+        self.encoder_batcher = None
+        self.decoder_batcher = None
 
     def transcribe(self, audio, init_prompt=""):
         logger.info("SimulWhisperASR's transcribe() should not be used. It's here only temporarily." \
@@ -113,6 +158,9 @@ class SimulWhisperASR(ASRBase):
         raise NotImplementedError("Use SimulWhisperOnline.process_iter() instead of transcribe().")
 
     def warmup(self, audio, init_prompt=""):
+        if self.model.compiled is not None:
+            # all the shapes, not only the ones of the warmup audio
+            self.model.compiled.warmup(self.model.cfg.beam_size, self.model.align_source)
         self.model.insert_audio(audio)
         self.model.infer(True)
         self.model.refresh_segment(complete=True)
@@ -124,16 +172,34 @@ class SimulWhisperASR(ASRBase):
         # this is not used. Translate task is set another way.
         pass
 
+    def new_online(self):
+        # the new processor shares the loaded weights and the compiled graphs, but it has its own segments,
+        # tokens, context and kv cache
+        draft_model = self.model.speculative.draft_model if self.model.speculative is not None else None
+        model = PaddedAlignAttWhisper(self.model.cfg, model=self.model.model, draft_model=draft_model,
+                                      compiled=self.model.compiled)
+        if self.encoder_batcher is not None:
+            model.use_batchers(self.encoder_batcher, self.decoder_batcher)
+        return SimulWhisperOnline(self, model=model)
+
+    def batch_inference(self, window, max_batch):
+        self.encoder_batcher = EncoderBatcher(self.model.model.encoder, window=window, max_batch=max_batch)
+        # a row of the shared kv cache per beam of every online processor, at most max_batch of them
+        self.decoder_batcher = DecoderBatcher(self.model.model, n_rows=max_batch*self.model.cfg.beam_size,
+                                              window=window, max_batch=max_batch)
+        self.model.use_batchers(self.encoder_batcher, self.decoder_batcher)
+
 
 class SimulWhisperOnline(OnlineProcessorInterface):
 
-    def __init__(self, asr):
-        self.model = asr.model
+    def __init__(self, asr, model=None):
+        self.model = asr.model if model is None else model
         self.file = None
         self.init()
 
     def init(self, offset=None):
-        self.audio_chunks = []
+        self.pending_len = 0  # samples inserted since the last process_iter
+        self.prepared = deque()  # (removed segments, encode_segments output) from prepare(), for decode()
         if offset is not None:
             self.offset = offset
         else:
@@ -149,7 +215,9 @@ class SimulWhisperOnline(OnlineProcessorInterface):
         self.unicode_buffer = []  # hide incomplete unicode character for the next iteration
 
     def insert_audio_chunk(self, audio):
-        self.audio_chunks.append(torch.from_numpy(audio))
+        # written directly to the audio buffer of the model, it's processed in the next process_iter
+        self.model.append_audio(torch.from_numpy(audio))
+        self.pending_len += audio.shape[0]
 
     def timestamped_text(self, tokens, generation):
         if not generation:
@@ -199,18 +267,27 @@ class SimulWhisperOnline(OnlineProcessorInterface):
             return tokens[:-1]  # remove the last token, which is incomplete unicode character
         return tokens
 
-    def process_iter(self):
-        if len(self.audio_chunks) == 0:
-            audio = None
-        else:
-            audio = torch.cat(self.audio_chunks, dim=0)
-            if audio.shape[0] == 0:
-                audio = None
-            else:
-                self.end += audio.shape[0] / self.SAMPLING_RATE
-        self.audio_chunks = []
-        self.audio_bufer_offset += self.model.insert_audio(audio)
-        tokens, generation_progress = self.model.infer(is_last=self.is_last)
+    def prepare(self):
+        """The first stage of process_iter: the inserted audio becomes a segment and it's encoded.
+        It runs the mel and the encoder and it doesn't touch the tokens nor context, so it can overlap with
+        decode() of the previous chunk in another thread (torch releases the GIL). The order must be:
+
+        - prepare() and decode() are called alternately, prepare() first, so that every decode() gets the
+          encoder output of its own chunk;
+        - prepare() of chunk N+1 may run only while decode() of chunk N runs, not earlier;
+        - insert_audio_chunk() of chunk N+1 may be called after prepare() of chunk N returned.
+        """
+        self.end += self.pending_len / self.SAMPLING_RATE
+        self.pending_len = 0
+        removed = self.model.close_segment()
+        self.prepared.append((removed, self.model.encode_segments()))
+
+    def decode(self):
+        """The second stage of process_iter, see prepare(). Returns the same as process_iter."""
+        removed, encoded = self.prepared.popleft()
+        # the tokens of the removed segments go to the context only now, after the previous decode()
+        self.audio_bufer_offset += self.model.drop_context(removed)
+        tokens, generation_progress = self.model.infer(is_last=self.is_last, encoded=encoded)
 
         tokens = self.hide_incomplete_unicode(tokens)
 
@@ -233,6 +310,10 @@ class SimulWhisperOnline(OnlineProcessorInterface):
         
         return (self.beg,e,text)
 
+    def process_iter(self):
+        self.prepare()
+        return self.decode()
+
     def finish(self):
         logger.info("Finish")
         self.is_last = True
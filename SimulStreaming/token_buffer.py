@@ -1,33 +1,56 @@
 import torch
 import sys
 class TokenBuffer:
+    '''The context tokens. The token ids are kept, the text and the tensors are made from them when
+    they are needed and cached until the buffer changes.'''
 
     def __init__(self, text="", tokenizer=None, device=None, prefix_token_ids=[]):
-        self.text = text
         self.prefix_token_ids = prefix_token_ids
         self.tokenizer = tokenizer
         self.device = device
+        self.token_ids = []
+        self.text = text
 
-    def as_token_ids(self, tokenizer=None):
+    def _changed(self, word_lens=None):
+        self._text = None
+        self._tensors = {}  # (beam, device): tensor
+        # the numbers of tokens of the words after the first `after` tokens, see trim_words
+        self._word_lens = word_lens
+
+    def _encode(self, text):
+        if self.tokenizer is None:
+            raise ValueError("Tokenizer is not set.")
+        return self.tokenizer.encode(text)
 
-        if tokenizer is None:
-            tokenizer = self.tokenizer
-        if tokenizer is None:
-            raise ValueError("Tokenizer is not set.") 
-        return self.prefix_token_ids + tokenizer.encode(self.text)
+    @property
+    def text(self):
+        if self._text is None:
+            self._text = self.tokenizer.decode(self.token_ids) if self.token_ids else ""
+        return self._text
+
+    @text.setter
+    def text(self, text):
+        self.token_ids = self._encode(text) if text else []
+        self._changed()
+
+    def as_token_ids(self, tokenizer=None):
+        if tokenizer is not None and tokenizer is not self.tokenizer:
+            return self.prefix_token_ids + tokenizer.encode(self.text)
+        return self.prefix_token_ids + self.token_ids
 
     def as_tensor(self, device=None):
+        return self.as_tensor_beam(1, device=device)
+
+    def as_tensor_beam(self, beam, device=None):
         if device is None:
             device = self.device
         if device is None:
             raise ValueError("Device is not set.")
-        tok_ids = self.as_token_ids()
-        return torch.tensor(tok_ids, 
-                     dtype=torch.long, device=device).unsqueeze(0)
-
-    def as_tensor_beam(self, beam, device=None):
-        t = self.as_tensor(device=device)
-        return t.repeat_interleave(beam, dim=0)
+        key = (beam, device)
+        if key not in self._tensors:
+            t = torch.tensor(self.as_token_ids(), dtype=torch.long, device=device).unsqueeze(0)
+            self._tensors[key] = t.repeat_interleave(beam, dim=0)
+        return self._tensors[key]
 
 
     def as_text(self):
@@ -40,34 +63,51 @@ class TokenBuffer:
     @staticmethod
     def from_text(text, *a, **kw):
         return TokenBuffer(*a, text=text, **kw)
-    
+
     def is_empty(self):
-        return self.text is None or self.text == ""
+        return not self.token_ids
+
+    def __len__(self):
+        '''the number of the token ids, without the prefix'''
+        return len(self.token_ids)
 
     def trim_words(self, num=1, after=0):
         '''
         num: how many words to trim from the beginning
-        after: how many characters to skip (length of the static prompt)
+        after: how many tokens to skip (length of the static prompt)
+        Returns the number of removed tokens.
         '''
         tokenizer = self.tokenizer
         assert tokenizer is not None, "Tokenizer is not set."
 
-        ids = tokenizer.encode(self.text[after:])
-        words, wids = self.tokenizer.split_to_word_tokens(ids)
+        # the word split is kept for the next call, the next words are the same after removing the first ones
+        if self._word_lens is None or self._word_lens[0] != after:
+            words, wids = tokenizer.split_to_word_tokens(self.token_ids[after:])
+            self._word_lens = (after, [len(wi) for wi in wids])
+        word_lens = self._word_lens[1]
 #        print(words, file=sys.stderr)
 #        print(wids, file=sys.stderr)
-        if not words:
+        if not word_lens:
             return 0
-        self.text = self.text[:after] + "".join(words[num:])
-        return sum(len(wi) for wi in wids[:num])
+        n = sum(word_lens[:num])
+        del self.token_ids[after:after + n]
+        self._changed(word_lens=(after, word_lens[num:]))
+        return n
 
     def append_token_ids(self, token_ids):
         tokenizer = self.tokenizer
         assert tokenizer is not None, "Tokenizer is not set."
-        self.text += self.tokenizer.decode(token_ids)
+        if isinstance(token_ids, torch.Tensor):
+            token_ids = token_ids.tolist()
+        # the same tokens as in the decoded text, timestamps are skipped
+        self.token_ids += [t for t in token_ids if t < tokenizer.timestamp_begin]
+        self._changed()
+
+    def append_text(self, text):
+        self.token_ids += self._encode(text)
+        self._changed()
 
     def as_split_word_tokens(self):
         tokenizer = self.tokenizer
         assert tokenizer is not None, "Tokenizer is not set."
-        ids = tokenizer.encode(self.text)
-        return tokenizer.split_to_word_tokens(ids)
+        return tokenizer.split_to_word_tokens(self.token_ids)
@@ -30,6 +30,16 @@ class ASRBase:
 
     def set_translate_task(self):
         raise NotImplemented("must be implemented in the child class")
+
+    def new_online(self):
+        '''Creates another online processor that shares this loaded model, e.g. for another client of the server.'''
+        raise NotImplementedError("must be implemented in the child class")
+
+    def batch_inference(self, window, max_batch):
+        '''Makes the online processors of this model (from new_online, too) run their encoder passes and
+        decoder steps in shared batches: the requests arriving within `window` seconds, up to max_batch.
+        There may be at most max_batch online processors, including the one from the factory.'''
+        raise NotImplementedError("must be implemented in the child class")
     
 
 class OnlineProcessorInterface:
@@ -0,0 +1,51 @@
+import numpy as np
+
+class PCM16Buffer:
+    '''Converts raw audio received from the network, signed 16-bit little endian PCM, to float32
+    samples in [-1,1), the same as soundfile does.
+
+    The samples are read by np.frombuffer directly from the received bytes and scaled into a
+    preallocated float32 buffer, without intermediate arrays. When a packet ends in the middle
+    of a sample, its first byte is kept and joined with the next packet.
+    '''
+
+    SCALE = np.float32(1/32768)
+
+    def __init__(self, capacity=16000):
+        self.audio = np.empty(capacity, dtype=np.float32)
+        self.len = 0  # number of samples in self.audio
+        self.carry = None  # the first byte of an incomplete sample
+
+    def __len__(self):
+        return self.len
+
+    def _reserve(self, n):
+        if self.len + n > len(self.audio):
+            audio = np.empty(max(2*len(self.audio), self.len + n), dtype=np.float32)
+            audio[:self.len] = self.audio[:self.len]
+            self.audio = audio
+
+    def add(self, raw_bytes):
+        '''raw_bytes: bytes, bytearray or memoryview. It's converted immediately, it can be reused after.'''
+        offset = 0
+        if self.carry is not None and len(raw_bytes) > 0:
+            self._reserve(1)
+            sample = np.frombuffer(self.carry + bytes(raw_bytes[:1]), dtype='<i2')
+            np.multiply(sample, self.SCALE, out=self.audio[self.len:self.len+1])
+            self.len += 1
+            self.carry = None
+            offset = 1
+        n = (len(raw_bytes) - offset) // 2
+        if n > 0:
+            self._reserve(n)
+            samples = np.frombuffer(raw_bytes, dtype='<i2', count=n, offset=offset)
+            np.multiply(samples, self.SCALE, out=self.audio[self.len:self.len+n])
+            self.len += n
+        if (len(raw_bytes) - offset) % 2:
+            self.carry = bytes(raw_bytes[-1:])
+
+    def take(self):
+        '''Returns a copy of all the samples in the buffer and empties it. The incomplete sample stays.'''
+        out = self.audio[:self.len].copy()
+        self.len = 0
+        return out
@@ -78,6 +78,17 @@ def asr_factory(args, factory=None):
 
     return asr, online
 
+def online_factory(asr, args):
+    """
+    Creates another online processor for asr from asr_factory, e.g. for another client of the server.
+    The model weights are shared, only the processing state is new.
+    """
+    online = asr.new_online()
+    if args.vac:
+        from whisper_streaming.vac_online_processor import VACOnlineASRProcessor
+        online = VACOnlineASRProcessor(args.min_chunk_size, online)
+    return online
+
 def set_logging(args,logger):
     logging.basicConfig(
         # this format would include module name:
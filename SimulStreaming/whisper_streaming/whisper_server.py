@@ -24,6 +24,7 @@ class Connection:
     def __init__(self, conn):
         self.conn = conn
         self.last_line = ""
+        self.packet = None  # reused for receiving audio
 
         self.conn.setblocking(True)
 
@@ -39,49 +40,65 @@ class Connection:
         return in_line
 
     def non_blocking_receive_audio(self):
+        '''returns a memoryview of the received bytes, valid until the next call'''
+        if self.packet is None:
+            self.packet = bytearray(self.PACKET_SIZE)
         try:
-            r = self.conn.recv(self.PACKET_SIZE)
-            return r
+            n = self.conn.recv_into(self.packet)
+            return memoryview(self.packet)[:n]
         except ConnectionResetError:
             return None
 
-import io
-import soundfile
+from whisper_streaming.pcm_buffer import PCM16Buffer
+import threading
+import itertools
+import json
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, wait
 
 # wraps socket and ASR object, and serves one client connection. 
 # next client should be served by a new instance of this object
 class ServerProcessor:
 
-    def __init__(self, c, online_asr_proc, min_chunk):
+    session_ids = itertools.count(1)
+
+    def __init__(self, c, online_asr_proc, min_chunk, executor=None, output_format="text", pipeline=False):
+        '''executor: worker pool shared by the sessions of the server, which runs the inference. 
+        If None, it runs in the calling thread.
+        output_format: "text" or "json", see format_output_transcript
+        pipeline: the encoder of the next chunk runs while the current chunk is decoded, see process_pipelined.
+        The online processor must have prepare() and decode(), as SimulWhisperOnline.'''
         self.connection = c
         self.online_asr_proc = online_asr_proc
         self.min_chunk = min_chunk
+        self.executor = executor
+        self.output_format = output_format
+        self.pipeline = pipeline
+        self.session_id = next(self.session_ids)
 
         self.last_end = None
 
         self.is_first = True
+        # received audio that is not processed yet
+        self.audio_buffer = PCM16Buffer(capacity=2*int(min_chunk*SAMPLING_RATE))
 
     def receive_audio_chunk(self):
         # receive all audio that is available by this time
         # blocks operation if less than self.min_chunk seconds is available
         # unblocks if connection is closed or a chunk is available
-        out = []
         minlimit = self.min_chunk*SAMPLING_RATE
-        while sum(len(x) for x in out) < minlimit:
+        while len(self.audio_buffer) < minlimit:
             raw_bytes = self.connection.non_blocking_receive_audio()
             if not raw_bytes:
                 break
-#            print("received audio:",len(raw_bytes), "bytes", raw_bytes[:10])
-            sf = soundfile.SoundFile(io.BytesIO(raw_bytes), channels=1,endian="LITTLE",samplerate=SAMPLING_RATE, subtype="PCM_16",format="RAW")
-            audio, _ = librosa.load(sf,sr=SAMPLING_RATE,dtype=np.float32)
-            out.append(audio)
-        if not out:
+            self.audio_buffer.add(raw_bytes)
+        if len(self.audio_buffer) == 0:
             return None
-        conc = np.concatenate(out)
-        if self.is_first and len(conc) < minlimit:
+        if self.is_first and len(self.audio_buffer) < minlimit:
             return None
         self.is_first = False
-        return np.concatenate(out)
+        return self.audio_buffer.take()
 
     def format_output_transcript(self,o):
         # output format in stdout is like:
@@ -95,6 +112,13 @@ class ServerProcessor:
         # Therefore, beg, is max of previous end and current beg outputed by Whisper.
         # Usually it differs negligibly, by appx 20 ms.
 
+        # With the "json" output format, every line is a JSON object instead:
+        # {"session": 1, "beg": 0, "end": 1720, "text": " Takhle to je", "is_final": true, "emission_time": 1722850000.123}
+        # - session: id of the client connection in this server
+        # - beg, end: the same timestamps in milliseconds
+        # - is_final: the text is not going to be revised. SimulStreaming emits only final text, it's appended to the previous one.
+        # - emission_time: the server time of sending, in seconds since the epoch
+
         if o[0] is not None:
             beg, end = o[0]*1000,o[1]*1000
             if self.last_end is not None:
@@ -102,6 +126,9 @@ class ServerProcessor:
 
             self.last_end = end
             print("%1.0f %1.0f %s" % (beg,end,o[2]),flush=True,file=sys.stderr)
+            if self.output_format == "json":
+                return json.dumps({"session": self.session_id, "beg": round(beg), "end": round(end), "text": o[2],
+                                   "is_final": True, "emission_time": time.time()}, ensure_ascii=False)
             return "%1.0f %1.0f %s" % (beg,end,o[2])
         else:
             logger.debug("No text in this segment")
@@ -112,15 +139,80 @@ class ServerProcessor:
         if msg is not None:
             self.connection.send(msg)
 
+    def process_chunk(self, a):
+        self.online_asr_proc.insert_audio_chunk(a)
+        return self.online_asr_proc.process_iter()
+
+    def prepare_chunk(self, a):
+        self.online_asr_proc.insert_audio_chunk(a)
+        self.online_asr_proc.prepare()
+
+    def decode(self, started):
+        '''online_asr_proc.decode(), in the decoding thread. started() is called when it begins, the next
+        chunk may be prepared only after that, see SimulWhisperOnline.prepare.'''
+        started()
+        return self.online_asr_proc.decode()
+
+    def decode_and_send(self, started):
+        o = self.decode(started)
+        self.send_result(o)
+
+    def wait_decoding(self, decoding):
+        '''returns False if the connection was closed'''
+        try:
+            decoding.result()
+        except BrokenPipeError:
+            logger.info("broken pipe -- connection closed?")
+            return False
+        return True
+
+    def process_pipelined(self):
+        # The chunk is decoded and its result is sent in another thread. Meanwhile, the next chunk
+        # is received and encoded, and it's decoded when the previous decoding finished. 
+        # The next chunk is prepared only when the decoding has started, not earlier.
+        # With the shared pool, the overlap needs at least 2 workers.
+        executor = self.executor or ThreadPoolExecutor(max_workers=1, thread_name_prefix="decoder")
+        self.online_asr_proc.init()
+        decoding = None
+        try:
+            while True:
+                a = self.receive_audio_chunk()
+                if a is None:
+                    break
+                if self.executor is None:
+                    self.prepare_chunk(a)
+                else:
+                    self.executor.submit(self.prepare_chunk, a).result()
+                if decoding is not None and not self.wait_decoding(decoding):
+                    break
+                started = threading.Event()
+                decoding = executor.submit(self.decode_and_send, started.set)
+                started.wait()
+            if decoding is not None:
+                self.wait_decoding(decoding)
+        finally:
+            # the online processor is not released while it's decoding
+            if decoding is not None:
+                wait([decoding])
+            if executor is not self.executor:
+                executor.shutdown()
+
     def process(self):
         # handle one client connection
+        if self.pipeline:
+            return self.process_pipelined()
         self.online_asr_proc.init()
         while True:
             a = self.receive_audio_chunk()
             if a is None:
                 break
-            self.online_asr_proc.insert_audio_chunk(a)
-            o = self.online_asr_proc.process_iter()
+            if self.executor is None:
+                o = self.process_chunk(a)
+            else:
+                # Backpressure: the session has at most one chunk in the pool. The audio sent meanwhile
+                # waits in the socket and it's received at once as the next chunk, or the client 
+                # is blocked by TCP flow control.
+                o = self.executor.submit(self.process_chunk, a).result()
             try:
                 self.send_result(o)
             except BrokenPipeError:
@@ -130,8 +222,246 @@ class ServerProcessor:
 #        o = online.finish()  # this should be working
 #        self.send_result(o)
 
-def main_server(factory, add_args):
+class SessionServer:
+    '''Serves up to max_sessions client connections at the same time, each in its own thread. 
+    All sessions share the loaded model, but each one has its own online processor 
+    (segments, tokens, context, kv cache). The inference is scheduled to a pool of `workers` threads.
+    The online processors are reused by the next connections.
+    Connections over max_sessions are closed immediately.
+    '''
+
+    def __init__(self, asr, online, args, min_chunk):
+        self.asr = asr
+        self.args = args
+        self.min_chunk = min_chunk
+        self.max_sessions = args.max_sessions
+        self.executor = ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix="inference")
+        if args.batch_window > 0:
+            asr.batch_inference(args.batch_window / 1000, max_batch=self.max_sessions)
+
+        self.lock = threading.Lock()
+        self.idle = [online]  # online processors that are not used by any session
+        self.num_sessions = 0
+
+    def acquire(self):
+        '''returns an online processor for a new session, or None if max_sessions are running'''
+        with self.lock:
+            if self.num_sessions >= self.max_sessions:
+                return None
+            self.num_sessions += 1
+            if self.idle:
+                return self.idle.pop()
+        # it loads only the processing state, not the model weights
+        return online_factory(self.asr, self.args)
+
+    def release(self, online):
+        with self.lock:
+            self.num_sessions -= 1
+            self.idle.append(online)
+
+    def serve(self, conn, addr, online):
+        try:
+            proc = ServerProcessor(Connection(conn), online, self.min_chunk, self.executor, self.args.output_format, self.args.pipeline)
+            proc.process()
+        except Exception:
+            logger.exception('Session of client {} failed'.format(addr))
+        finally:
+            conn.close()
+            self.release(online)
+            logger.info('Connection to client {} closed'.format(addr))
+
+    def serve_forever(self, s):
+        while True:
+            conn, addr = s.accept()
+            online = self.acquire()
+            if online is None:
+                logger.warning('Refused client on {}: {} sessions are running'.format(addr, self.max_sessions))
+                conn.close()
+                continue
+            logger.info('Connected to client on {}'.format(addr))
+            threading.Thread(target=self.serve, args=(conn, addr, online), daemon=True).start()
+
+######### Asyncio server objects
+
+class AsyncConnection:
+    '''it wraps asyncio streams, it sends lines like Connection'''
+    READ_SIZE = 65536
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.last_line = ""
+
+    def send(self, line):
+        '''it doesn't send the same line twice, like Connection. The line is buffered, call drain() after.'''
+        if line == self.last_line:
+            return
+        lines = line.splitlines()
+        first_line = lines[0] if lines else ""
+        self.writer.write(first_line.encode('utf-8', errors='replace') + b'\n')
+        self.last_line = line
+
+    async def drain(self):
+        await self.writer.drain()
+
+    async def receive_audio(self):
+        try:
+            return await self.reader.read(self.READ_SIZE)
+        except ConnectionResetError:
+            return None
+
+class AsyncServerProcessor(ServerProcessor):
+    '''Serves one client connection in the asyncio event loop. The audio is received into a buffer
+    by a separate task all the time, while the inference runs in the executor. Each process_iter gets 
+    all the audio that arrived meanwhile, at least min_chunk seconds.
     '''
+
+    # the receiving pauses when this many min_chunks are buffered, so that TCP flow control slows down
+    # the client while the inference is behind
+    MAX_BUFFERED_CHUNKS = 4
+
+    def __init__(self, c, online_asr_proc, min_chunk, executor, output_format="text", pipeline=False):
+        super().__init__(c, online_asr_proc, min_chunk, executor, output_format, pipeline)
+        self.arrived = asyncio.Event()
+        self.taken = asyncio.Event()
+        self.closed = False
+
+    async def receive_loop(self):
+        max_buffered = self.MAX_BUFFERED_CHUNKS*self.min_chunk*SAMPLING_RATE
+        try:
+            while True:
+                while len(self.audio_buffer) >= max_buffered:
+                    self.taken.clear()
+                    await self.taken.wait()
+                raw_bytes = await self.connection.receive_audio()
+                if not raw_bytes:
+                    break
+                self.audio_buffer.add(raw_bytes)
+                self.arrived.set()
+        finally:
+            # also on errors and cancellation, receive_audio_chunk must not wait for more audio
+            self.closed = True
+            self.arrived.set()
+
+    async def receive_audio_chunk(self):
+        # waits for min_chunk seconds of audio or for the end of the connection, and returns all audio
+        # that is available by this time
+        minlimit = self.min_chunk*SAMPLING_RATE
+        while len(self.audio_buffer) < minlimit and not self.closed:
+            self.arrived.clear()
+            await self.arrived.wait()
+        if len(self.audio_buffer) == 0:
+            return None
+        if self.is_first and len(self.audio_buffer) < minlimit:
+            return None
+        self.is_first = False
+        a = self.audio_buffer.take()
+        self.taken.set()
+        return a
+
+    async def decode_and_send_async(self, started):
+        '''returns False if the connection was closed. started is set when the decoding begins in the executor.'''
+        loop = asyncio.get_running_loop()
+        o = await loop.run_in_executor(self.executor, self.decode, lambda: loop.call_soon_threadsafe(started.set))
+        try:
+            self.send_result(o)
+            await self.connection.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            logger.info("broken pipe -- connection closed?")
+            return False
+        return True
+
+    async def process_pipelined(self):
+        # as ServerProcessor.process_pipelined: the next chunk is encoded while the current one is decoded,
+        # and not before the decoding started
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, self.online_asr_proc.init)
+        receiver = asyncio.create_task(self.receive_loop())
+        decoding = None
+        try:
+            while True:
+                a = await self.receive_audio_chunk()
+                if a is None:
+                    break
+                await loop.run_in_executor(self.executor, self.prepare_chunk, a)
+                if decoding is not None and not await decoding:
+                    break
+                started = asyncio.Event()
+                decoding = asyncio.create_task(self.decode_and_send_async(started))
+                # the task may also fail before the decoding starts, e.g. when the executor is shut down
+                waiting = asyncio.create_task(started.wait())
+                await asyncio.wait([waiting, decoding], return_when=asyncio.FIRST_COMPLETED)
+                waiting.cancel()
+            if decoding is not None:
+                await decoding
+        finally:
+            receiver.cancel()
+            if decoding is not None:
+                await asyncio.wait([decoding])
+
+    async def process(self):
+        if self.pipeline:
+            return await self.process_pipelined()
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, self.online_asr_proc.init)
+        receiver = asyncio.create_task(self.receive_loop())
+        try:
+            while True:
+                a = await self.receive_audio_chunk()
+                if a is None:
+                    break
+                o = await loop.run_in_executor(self.executor, self.process_chunk, a)
+                try:
+                    self.send_result(o)
+                    await self.connection.drain()
+                except (BrokenPipeError, ConnectionResetError):
+                    logger.info("broken pipe -- connection closed?")
+                    break
+        finally:
+            receiver.cancel()
+
+async def close_writer(writer):
+    '''closes the connection and waits until the transport is closed, the connection errors are ignored'''
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except OSError:
+        pass
+
+class AsyncSessionServer(SessionServer):
+    '''SessionServer in asyncio. Up to max_sessions connections are served at the same time, 
+    the connections over the limit are closed immediately.'''
+
+    async def serve_client(self, reader, writer):
+        addr = writer.get_extra_info('peername')
+        online = self.acquire()
+        if online is None:
+            logger.warning('Refused client on {}: {} sessions are running'.format(addr, self.max_sessions))
+            await close_writer(writer)
+            return
+        logger.info('Connected to client on {}'.format(addr))
+        try:
+            proc = AsyncServerProcessor(AsyncConnection(reader, writer), online, self.min_chunk, self.executor, self.args.output_format,
+                                        self.args.pipeline)
+            await proc.process()
+        except Exception:
+            logger.exception('Session of client {} failed'.format(addr))
+        finally:
+            await close_writer(writer)
+            self.release(online)
+            logger.info('Connection to client {} closed'.format(addr))
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.serve_client, host, port)
+        logger.info('Listening on'+str((host, port)))
+        async with server:
+            await server.serve_forever()
+
+def start_server(factory, add_args):
+    '''
+    Parses the server arguments, creates the ASR and online processor and warms them up.
+    Returns args, asr, online and min_chunk.
+
     factory: function that creates the ASR and online processor object from args and logger.  
             or in the default WhisperStreaming local agreement backends (not implemented but could be).
     add_args: add specific args for the backend
@@ -145,6 +475,22 @@ def main_server(factory, add_args):
     parser.add_argument("--warmup-file", type=str, dest="warmup_file", 
             help="The path to a speech audio wav file to warm up Whisper so that the very first chunk processing is fast. It can be e.g. "
             "https://github.com/ggerganov/whisper.cpp/raw/master/samples/jfk.wav .")
+    parser.add_argument("--output-format", type=str, dest="output_format", default="text", choices=["text", "json"],
+            help="Format of the output lines sent to the client: 'beg end text', or a JSON object per line "
+            "with the session id, beg, end, text, is_final and emission_time.")
+    parser.add_argument("--max-sessions", type=int, dest="max_sessions", default=1,
+            help="Maximum number of client connections served at the same time. They share the model weights. "
+            "The connections over the limit are refused. With 1, the clients are served one by one.")
+    parser.add_argument("--workers", type=int, default=1,
+            help="Number of threads that run the inference for the sessions, in the asyncio server or if --max-sessions is more than 1.")
+    parser.add_argument("--batch-window", type=float, dest="batch_window", default=0,
+            help="If positive, the encoder passes and the decoder steps of the sessions that arrive within this time window, in milliseconds, "
+            "run in one batch. It needs --max-sessions more than 1, and --workers as many as sessions that should be batched together. "
+            "Not with --compile.")
+    parser.add_argument("--pipeline", action="store_true", default=False,
+            help="The mel and encoder of the next chunk run in another thread while the current chunk is decoded. The output is the same. "
+            "It needs an online processor with separate encoding and decoding stages, i.e. SimulStreaming without --vac. "
+            "In the asyncio server or with --max-sessions more than 1, it needs --workers at least 2 per session.")
 
     # options from whisper_online
     processor_args(parser)
@@ -155,10 +501,23 @@ def main_server(factory, add_args):
 
     set_logging(args,logger)
 
+    if args.max_sessions < 1 or args.workers < 1:
+        logger.critical("--max-sessions and --workers must be at least 1.")
+        sys.exit(1)
+    if args.batch_window < 0:
+        logger.critical("--batch-window must not be negative.")
+        sys.exit(1)
+    if args.batch_window > 0 and getattr(args, "compile", False):
+        logger.critical("--batch-window can't be used with --compile, the batches run in the eager mode.")
+        sys.exit(1)
+
     # setting whisper object by args 
 
 
     asr, online = asr_factory(args, factory)
+    if args.pipeline and not hasattr(online, "prepare"):
+        logger.warning("The online processor can't be pipelined, e.g. with --vac. Running without --pipeline.")
+        args.pipeline = False
     if args.vac:
         min_chunk = args.vac_chunk_size
     else:
@@ -177,19 +536,40 @@ def main_server(factory, add_args):
             sys.exit(1)
     else:
         logger.warning(msg)
+    return args, asr, online, min_chunk
+
+def main_server(factory, add_args):
+    '''
+    factory: function that creates the ASR and online processor object from args and logger.  
+            or in the default WhisperStreaming local agreement backends (not implemented but could be).
+    add_args: add specific args for the backend
+    '''
+    args, asr, online, min_chunk = start_server(factory, add_args)
 
     # server loop
 
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
         s.bind((args.host, args.port))
-        s.listen(1)
+        s.listen(args.max_sessions)
         logger.info('Listening on'+str((args.host, args.port)))
+        if args.max_sessions > 1:
+            SessionServer(asr, online, args, min_chunk).serve_forever(s)
         while True:
             conn, addr = s.accept()
             logger.info('Connected to client on {}'.format(addr))
             connection = Connection(conn)
-            proc = ServerProcessor(connection, online, min_chunk)
+            proc = ServerProcessor(connection, online, min_chunk, output_format=args.output_format, pipeline=args.pipeline)
             proc.process()
             conn.close()
             logger.info('Connection to client closed')
-    logger.info('Connection closed, terminating.')
\ No newline at end of file
+    logger.info('Connection closed, terminating.')
+
+def main_async_server(factory, add_args):
+    '''
+    The same as main_server, but the connections are served by asyncio. The audio is received
+    all the time, also while the inference of the session runs in the worker pool.
+    factory, add_args: as in main_server
+    '''
+    args, asr, online, min_chunk = start_server(factory, add_args)
+    server = AsyncSessionServer(asr, online, args, min_chunk)
+    asyncio.run(server.serve(args.host, args.port))
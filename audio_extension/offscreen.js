@@ -1,14 +1,29 @@
+// 'pcm': an AudioWorklet sends 16 kHz mono Int16 frames of FRAME_MS, which the gateway forwards without decoding.
+// 'webm': MediaRecorder sends WebM/Opus chunks every second, which the gateway decodes.
+const CAPTURE_MODE = 'pcm';
+const PCM_RATE = 16000;
+const FRAME_MS = 40;
+
 let recorder;
 let data = [];
 let mediaStream;
 let socket;
 let audioContext;
+let workletNode;
+
+// tells the gateway that the binary messages are raw PCM, on every (re)connection
+function sendFormat() {
+  if (workletNode && socket && socket.readyState == WebSocket.OPEN) {
+    socket.send(JSON.stringify({ format: 's16le', sample_rate: PCM_RATE, channels: 1 }));
+  }
+}
 
 function connectWebSocket() {
   socket = new WebSocket("ws://localhost:8765"); // Python WebSocket server
 
   socket.onopen = () => {
     console.log("WebSocket connected");
+    sendFormat();
   };
 
   socket.onclose = () => {
@@ -56,6 +71,11 @@ async function startRecording(streamId) {
     const source = audioContext.createMediaStreamSource(mediaStream);
     source.connect(audioContext.destination);
 
+    if (CAPTURE_MODE === 'pcm') {
+      await startPCMCapture(source);
+      return;
+    }
+
     // Create recorder
     recorder = new MediaRecorder(mediaStream, { mimeType: 'audio/webm' });
     
@@ -117,10 +137,33 @@ async function startRecording(streamId) {
   }
 }
 
+async function startPCMCapture(source) {
+  await audioContext.audioWorklet.addModule('pcm-worklet.js');
+  workletNode = new AudioWorkletNode(audioContext, 'pcm-capture', {
+    processorOptions: { targetRate: PCM_RATE, frameMs: FRAME_MS }
+  });
+  workletNode.port.onmessage = (event) => {
+    if (socket && socket.readyState == WebSocket.OPEN) {
+      socket.send(event.data);
+    }
+  };
+  sendFormat();
+  source.connect(workletNode);
+  // the output is silent, it's connected only to keep the node processing
+  workletNode.connect(audioContext.destination);
+  console.log("Offscreen: PCM capture started");
+}
+
 function stopRecording() {
   console.log("Offscreen: Stop recording requested");
   
   try {
+    if (workletNode) {
+      workletNode.port.onmessage = null;
+      workletNode.disconnect();
+      workletNode = null;
+      console.log("Offscreen: PCM capture stopped.");
+    }
     
     if (audioContext && audioContext.state !== 'closed') {
       audioContext.close();
@@ -0,0 +1,51 @@
+// AudioWorklet that converts the tab audio to 16 kHz mono Int16 PCM and posts it in small frames.
+// Every output sample is the average of the input samples it covers, which is a simple low-pass
+// filter for the downsampling. Int16Array is little endian on the platforms Chrome runs on.
+class PCMCaptureProcessor extends AudioWorkletProcessor {
+  constructor(options) {
+    super();
+    const opts = options.processorOptions || {};
+    this.targetRate = opts.targetRate || 16000;
+    this.frameSamples = Math.round(this.targetRate * (opts.frameMs || 40) / 1000);
+    this.ratio = sampleRate / this.targetRate; // sampleRate is the rate of the AudioContext
+
+    this.frame = new Int16Array(this.frameSamples);
+    this.frameLength = 0;
+    this.sum = 0;   // sum of the input samples of the current output sample
+    this.count = 0; // their number
+    this.pos = 0;   // input samples since the start of the current output sample
+  }
+
+  process(inputs) {
+    const input = inputs[0];
+    if (input.length === 0) {
+      return true;
+    }
+    const channels = input.length;
+    for (let i = 0; i < input[0].length; i++) {
+      let s = 0;
+      for (let c = 0; c < channels; c++) {
+        s += input[c][i];
+      }
+      this.sum += s / channels;
+      this.count++;
+      this.pos++;
+      if (this.pos >= this.ratio) {
+        this.pos -= this.ratio;
+        const v = Math.round(this.sum / this.count * 32768);
+        this.frame[this.frameLength++] = Math.max(-32768, Math.min(32767, v));
+        this.sum = 0;
+        this.count = 0;
+        if (this.frameLength === this.frameSamples) {
+          // the buffer is transferred, not copied
+          this.port.postMessage(this.frame.buffer, [this.frame.buffer]);
+          this.frame = new Int16Array(this.frameSamples);
+          this.frameLength = 0;
+        }
+      }
+    }
+    return true;
+  }
+}
+
+registerProcessor('pcm-capture', PCMCaptureProcessor);
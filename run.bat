@@ -10,6 +10,6 @@ timeout /t 3 /nobreak >nul
 
 ECHO Starting All Services in Windows Terminal...
 
-start "" wt.exe --window 0 nt --title "Transcription Server" cmd /c "cd /d d:\PROJECT\podcast-overlay\SimulStreaming && python simulstreaming_whisper_server.py --model_path base.en --language en --task transcribe --warmup-file ../samples/jfk.mp3 --log-level WARNING --max_context_tokens 400 --audio_max_len 30.0" ; split-pane --horizontal --title "Gateway Server" cmd /c "cd /d d:\PROJECT\podcast-overlay && timeout /t 5 && python websocket.py" ; split-pane --vertical --title "Overlay Client" cmd /c "cd /d d:\PROJECT\podcast-overlay && python simple_overlay.py"
+start "" wt.exe --window 0 nt --title "Transcription Server" cmd /c "cd /d d:\PROJECT\podcast-overlay\SimulStreaming && python simulstreaming_whisper_server.py --model_path base.en --language en --task transcribe --warmup-file ../samples/jfk.mp3 --log-level WARNING --max_context_tokens 400 --audio_max_len 30.0 --output-format json" ; split-pane --horizontal --title "Gateway Server" cmd /c "cd /d d:\PROJECT\podcast-overlay && timeout /t 5 && python websocket.py" ; split-pane --vertical --title "Overlay Client" cmd /c "cd /d d:\PROJECT\podcast-overlay && python simple_overlay.py"
 
 ECHO All services launched in a single Windows Terminal window.
\ No newline at end of file
@@ -1,6 +1,7 @@
 # simple_overlay_realtime.py
 import sys
 import time
+import json
 import asyncio  # Thêm vào
 import websockets # Thêm vào
 from pathlib import Path
@@ -13,11 +14,15 @@ import win32con
 # Lớp StreamingTextOverlay giữ nguyên, không cần thay đổi
 class StreamingTextOverlay(QMainWindow):
     """Simple overlay that displays streaming text"""
+
+    CAPTION_CHARS = 150  # the end of the transcript that is shown, about two lines
     
     def __init__(self):
         super().__init__()
         self.setup_ui()
         self.current_text = ""
+        self.final_text = ""  # transcript that is not going to change
+        self.interim_text = ""  # the latest text that is not final, it's replaced by the next result
         self.worker = None
         
         self.topmost_timer = QTimer()
@@ -66,6 +71,21 @@ class StreamingTextOverlay(QMainWindow):
         if text != self.current_text:
             self.current_text = text
             self.text_label.setText(text if text else "...")
+
+    def apply_result(self, result):
+        """result: a message of the gateway, {"text", "is_final", ...}. Final text is appended to the transcript,
+        interim text is shown after it until the next result."""
+        if result.get("is_final", True):
+            self.final_text = (self.final_text + result.get("text", ""))[-10 * self.CAPTION_CHARS:]
+            self.interim_text = ""
+        else:
+            self.interim_text = result.get("text", "")
+        caption = (self.final_text + self.interim_text).strip()
+        if len(caption) > self.CAPTION_CHARS:
+            caption = caption[-self.CAPTION_CHARS:]
+            # start at a word boundary
+            caption = caption.split(" ", 1)[-1]
+        self.update_text(caption)
             
     def force_topmost(self):
         hwnd = int(self.winId())
@@ -95,6 +115,7 @@ class StreamingTextOverlay(QMainWindow):
 class WebSocketClientThread(QThread):
     """Runs the WebSocket client in the background to listen for transcriptions."""
     text_updated = Signal(str)
+    result_received = Signal(dict)
     
     def __init__(self, uri):
         super().__init__()
@@ -115,7 +136,14 @@ class WebSocketClientThread(QThread):
                     async for message in websocket:
                         if not self.running:
                             break
-                        self.text_updated.emit(message)
+                        try:
+                            result = json.loads(message)
+                        except ValueError:
+                            result = None
+                        if isinstance(result, dict):
+                            self.result_received.emit(result)
+                        else:
+                            self.text_updated.emit(message)
             except (websockets.exceptions.ConnectionClosedError, ConnectionRefusedError) as e:
                 error_message = f"Connection lost: {e}. Retrying in 5s..."
                 self.text_updated.emit(error_message)
@@ -158,6 +186,7 @@ if __name__ == "__main__":
     worker = WebSocketClientThread(server_uri)
     overlay.worker = worker
     worker.text_updated.connect(overlay.update_text) 
+    worker.result_received.connect(overlay.apply_result)
     worker.start()
     
     # Clean shutdown
@@ -1,91 +1,312 @@
 # websocket.py (đã sửa đổi)
 import asyncio
+import io
+import json
+import queue
+import threading
+import time
 import websockets
 import ffmpeg
 from asyncio.subprocess import PIPE
 
+# PyAV decodes the audio in this process. Without it, the audio is decoded by an ffmpeg subprocess.
+try:
+    import av
+except ImportError:
+    av = None
+
+TRANSCRIBER_HOST = 'localhost'
+TRANSCRIBER_PORT = 43007 # Đảm bảo port này đúng với server SimulStreaming
+
 # --- THAY ĐỔI 1: Tạo một "danh bạ" global cho các client ---
+# All clients, producers and subscribers. They all receive the transcription.
 CONNECTED_CLIENTS = set()
 
-async def handler(ws):
-    # --- THAY ĐỔI 2: Thêm client vào danh bạ khi kết nối ---
-    CONNECTED_CLIENTS.add(ws)
-    print(f'New client connected. Total clients: {len(CONNECTED_CLIENTS)}')
-    
+# Connections to the transcription server that no producer uses now. The next producer reuses them.
+IDLE_TRANSCRIBERS = []
+
+
+class Transcriber:
+    """A connection to the transcription server. Its results are broadcast to all clients.
+    It stays open when its producer disconnects, so that the next producer doesn't wait for a new session."""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.receiver = asyncio.create_task(self.receive_from_transcriber())
+
+    @classmethod
+    async def open(cls):
+        reader, writer = await asyncio.open_connection(TRANSCRIBER_HOST, TRANSCRIBER_PORT)
+        print("Connected to transcription server.")
+        return cls(reader, writer)
+
+    def is_open(self):
+        return not self.writer.is_closing() and not self.receiver.done()
+
+    async def send(self, pcm_data):
+        self.writer.write(pcm_data)
+        await self.writer.drain()
+
+    async def receive_from_transcriber(self):
+        # the results are lines, split only at complete lines, so that a multi-byte character is never split
+        buffer = bytearray()
+        try:
+            while not self.reader.at_eof():
+                result_bytes = await self.reader.read(4096)
+                if not result_bytes: break
+                buffer += result_bytes
+                start = 0
+                while (end := buffer.find(b'\n', start)) >= 0:
+                    line = buffer[start:end].decode('utf-8', errors='replace').strip('\0').strip()
+                    start = end + 1
+                    if line:
+                        result = result_message(line)
+                        print("Transcription:", result)
+                        # --- THAY ĐỔI 3: Gửi kết quả cho TẤT CẢ client ---
+                        websockets.broadcast(CONNECTED_CLIENTS, result)
+                del buffer[:start]
+        except Exception as e:
+            print(f'[TRANSCRIBER_RECEIVER] Error: {e}')
+        finally:
+            if not self.writer.is_closing():
+                self.writer.close()
+            print("Connection to transcription server closed.")
+
+
+def result_message(line):
+    """The JSON message for the clients from a result line of the transcription server:
+    {"session", "beg", "end", "text", "is_final", "emission_time"}, see --output-format json of the server.
+    Lines of the text format 'beg end text' are converted to it."""
+    if line.startswith('{'):
+        return line
+    parts = line.split(' ', 2)
     try:
-        process = await asyncio.create_subprocess_exec(
+        beg, end = int(parts[0]), int(parts[1])
+    except (ValueError, IndexError):
+        beg, end = None, None
+        parts = [None, None, line]
+    return json.dumps({"session": None, "beg": beg, "end": end, "text": parts[2] if len(parts) > 2 else "",
+                       "is_final": True, "emission_time": time.time()}, ensure_ascii=False)
+
+
+async def get_transcriber():
+    while IDLE_TRANSCRIBERS:
+        transcriber = IDLE_TRANSCRIBERS.pop()
+        if transcriber.is_open():
+            return transcriber
+    return await Transcriber.open()
+
+
+def release_transcriber(transcriber):
+    if transcriber.is_open():
+        IDLE_TRANSCRIBERS.append(transcriber)
+
+
+class FFmpegDecoder:
+    """Decodes the WebM audio from the extension to raw PCM, 16 kHz mono s16le, by an ffmpeg subprocess.
+    The output is raw, without a WAV header."""
+
+    async def start(self):
+        self.process = await asyncio.create_subprocess_exec(
             'ffmpeg',
             '-i', 'pipe:0',
-            '-f', 'wav', '-acodec', 'pcm_s16le', '-ar', '16000', '-ac', '1',
+            '-f', 's16le', '-acodec', 'pcm_s16le', '-ar', '16000', '-ac', '1',
             'pipe:1',
             stdin=PIPE, stdout=PIPE, stderr=PIPE
         )
 
-        try:
-            transcribe_reader, transcribe_writer = await asyncio.open_connection(
-                'localhost', 43007 # Đảm bảo port này đúng với server SimulStreaming
-            )
-            print("Connected to transcription server.")
-        except ConnectionRefusedError:
-            print("Connection to transcription server failed.")
-            process.kill()
-            await process.wait()
-            return
-
-        async def forward_to_ffmpeg():
-            try:
-                # Vòng lặp này sẽ chỉ nhận audio từ client nào thực sự gửi
-                async for message in ws:
-                    process.stdin.write(message)
-                    await process.stdin.drain()
-            except websockets.exceptions.ConnectionClosedError:
-                # Client ngắt kết nối là bình thường, không cần báo lỗi
-                pass
-            except Exception as e:
-                print(f'[FORWARDER] Error: {e}')
-            finally:
-                if not process.stdin.is_closing():
-                    process.stdin.close()
-
-        async def forward_to_transcriber():
-            try:
-                while not process.stdout.at_eof():
-                    wav_data = await process.stdout.read(4096)
-                    if not wav_data: break
-                    transcribe_writer.write(wav_data)
-                    await transcribe_writer.drain()
-            except Exception as e:
-                print(f'[TRANSCRIBER_SENDER] Error: {e}')
-            finally:
-                if not transcribe_writer.is_closing():
-                    transcribe_writer.close()
-
-        async def receive_from_transcriber():
-            try:
-                while not transcribe_reader.at_eof():
-                    result_bytes = await transcribe_reader.read(1024)
-                    if not result_bytes: break
-                    result = result_bytes.decode('utf-8', errors='ignore')
-                    if result:
-                        print("Transcription:", result)
-                        # --- THAY ĐỔI 3: Gửi kết quả cho TẤT CẢ client ---
-                        websockets.broadcast(CONNECTED_CLIENTS, result)
-            except Exception as e:
-                print(f'[TRANSCRIBER_RECEIVER] Error: {e}')
-        
-        await asyncio.gather(
-            forward_to_ffmpeg(),
-            forward_to_transcriber(),
-            receive_from_transcriber()
-        )
+    async def write(self, data):
+        self.process.stdin.write(data)
+        await self.process.stdin.drain()
+
+    def close_input(self):
+        if not self.process.stdin.is_closing():
+            self.process.stdin.close()
+
+    async def read(self):
+        """Returns the next PCM bytes, or b'' at the end."""
+        return await self.process.stdout.read(4096)
 
-        await transcribe_writer.wait_closed() 
-        stdout, stderr = await process.communicate()
-        print("FFMPEG exited with code:", process.returncode)
+    async def wait(self):
+        stdout, stderr = await self.process.communicate()
+        print("FFMPEG exited with code:", self.process.returncode)
         if stderr:
             print("FFMPEG stderr output:", stderr.decode())
-        print(f"Handler for a client finished.")
 
+
+class ChunkReader(io.RawIOBase):
+    """Blocking file object over the received chunks, for PyAV in the decoding thread."""
+
+    def __init__(self):
+        self.chunks = queue.Queue()  # None is the end of input
+        self.buffer = b''
+        self.eof = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.buffer and not self.eof:
+            chunk = self.chunks.get()
+            if chunk is None:
+                self.eof = True
+            else:
+                self.buffer = chunk
+        n = min(len(b), len(self.buffer))
+        b[:n] = self.buffer[:n]
+        self.buffer = self.buffer[n:]
+        return n
+
+
+class PyAVDecoder:
+    """Decodes the WebM/Opus audio from the extension to raw PCM, 16 kHz mono s16le, by PyAV in a thread
+    of this process. The demuxer reads the chunks as they arrive and the resampler converts every
+    decoded frame, so the PCM is sent on without waiting for the end of the stream."""
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.input = ChunkReader()
+        self.output = asyncio.Queue()
+        self.finished = False  # the decoding thread has ended, e.g. on an error
+        self.thread = threading.Thread(target=self.decode, daemon=True)
+        self.thread.start()
+
+    async def write(self, data):
+        # nothing reads the chunks after the decoding ended, as with the stdin of an exited ffmpeg
+        if self.finished:
+            raise BrokenPipeError("the audio decoder has stopped")
+        self.input.chunks.put(bytes(data))
+
+    def close_input(self):
+        self.input.chunks.put(None)
+
+    async def read(self):
+        """Returns the next PCM bytes, or b'' at the end."""
+        return await self.output.get()
+
+    async def wait(self):
+        await asyncio.to_thread(self.thread.join)
+
+    def emit(self, pcm_data):
+        self.loop.call_soon_threadsafe(self.output.put_nowait, pcm_data)
+
+    def decode(self):
+        try:
+            # small probing, the stream parameters are in the WebM header
+            with av.open(self.input, mode='r', format='webm', options={'probesize': '4096', 'analyzeduration': '0'}) as container:
+                resampler = av.AudioResampler(format='s16', layout='mono', rate=16000)
+                for frame in container.decode(audio=0):
+                    for out in resampler.resample(frame):
+                        self.emit(out.to_ndarray().tobytes())
+                for out in resampler.resample(None):
+                    self.emit(out.to_ndarray().tobytes())
+        except Exception as e:
+            print(f'[DECODER] Error: {e}')
+        finally:
+            # `finished` stops the further writes of WebM, and the empty chunk ends the reader coroutine
+            self.finished = True
+            self.emit(b'')
+        print("Decoder finished.")
+
+
+async def forward_pcm(ws, first_message, transcriber):
+    """Raw 16 kHz mono s16le frames, from the PCM capture mode of the extension, go to the transcriber without decoding."""
+    try:
+        await transcriber.send(first_message)
+        async for message in ws:
+            if isinstance(message, bytes):
+                await transcriber.send(message)
+    except websockets.exceptions.ConnectionClosedError:
+        pass
+    except Exception as e:
+        print(f'[FORWARDER] Error: {e}')
+
+
+async def produce(ws, first_message, audio_format):
+    """The pipeline of a client that sends audio: it's decoded to PCM and it goes to a transcriber.
+    audio_format: 's16le' for raw PCM that is the format of the transcriber, otherwise it's WebM."""
+    try:
+        transcriber = await get_transcriber()
+    except ConnectionRefusedError:
+        print("Connection to transcription server failed.")
+        return
+
+    if audio_format == 's16le':
+        await forward_pcm(ws, first_message, transcriber)
+        release_transcriber(transcriber)
+        return
+
+    decoder = PyAVDecoder() if av is not None else FFmpegDecoder()
+    await decoder.start()
+
+    async def forward_to_decoder():
+        try:
+            await decoder.write(first_message)
+            # Vòng lặp này sẽ chỉ nhận audio từ client nào thực sự gửi
+            async for message in ws:
+                await decoder.write(message)
+        except websockets.exceptions.ConnectionClosedError:
+            # Client ngắt kết nối là bình thường, không cần báo lỗi
+            pass
+        except Exception as e:
+            # the decoder failed, the rest of the audio can't be transcribed
+            print(f'[FORWARDER] Error: {e}')
+            await ws.close(code=1011, reason='audio decoding failed')
+        finally:
+            decoder.close_input()
+
+    async def forward_to_transcriber():
+        try:
+            while True:
+                pcm_data = await decoder.read()
+                if not pcm_data: break
+                await transcriber.send(pcm_data)
+        except Exception as e:
+            print(f'[TRANSCRIBER_SENDER] Error: {e}')
+
+    await asyncio.gather(
+        forward_to_decoder(),
+        forward_to_transcriber(),
+    )
+
+    await decoder.wait()
+    release_transcriber(transcriber)
+
+
+def parse_format(message, audio_format):
+    try:
+        fmt = json.loads(message)
+    except ValueError:
+        return audio_format
+    if not isinstance(fmt, dict) or "format" not in fmt:
+        return audio_format
+    if fmt == {"format": "s16le", "sample_rate": 16000, "channels": 1}:
+        return 's16le'
+    print(f"Unsupported audio format: {fmt}")
+    return audio_format
+
+
+async def handler(ws):
+    # --- THAY ĐỔI 2: Thêm client vào danh bạ khi kết nối ---
+    CONNECTED_CLIENTS.add(ws)
+    print(f'New client connected. Total clients: {len(CONNECTED_CLIENTS)}')
+
+    try:
+        # A client is a subscriber (e.g. the overlay) until it sends audio. Subscribers only
+        # receive the broadcast, they don't start ffmpeg nor a transcription session.
+        # A producer can announce raw PCM by a text message {"format": "s16le", "sample_rate": 16000, "channels": 1}
+        # before the audio. Otherwise, the audio is WebM.
+        audio_format = 'webm'
+        async for message in ws:
+            if isinstance(message, bytes):
+                print(f"Client sends audio ({audio_format}), starting the pipeline.")
+                await produce(ws, message, audio_format)
+                break
+            audio_format = parse_format(message, audio_format)
+        print(f"Handler for a client finished.")
+    except websockets.exceptions.ConnectionClosedError:
+        pass
     finally:
         # --- THAY ĐỔI 4: Xóa client khỏi danh bạ khi ngắt kết nối ---
         CONNECTED_CLIENTS.remove(ws)
@@ -97,4 +318,4 @@ async def main():
         print("listening ws://localhost:8765")
         await asyncio.Future()
 
-asyncio.run(main())
\ No newline at end of file
+asyncio.run(main())